@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+"""
+Performance benchmarks for tweak. Run ``python test/benchmark.py [benchmark ...]`` or ``make bench``; results are
+printed as JSON, along with the commit and Python version they were measured with. Use ``--output`` to save them to a
+file, and ``--compare`` to print the ratio of each result to the same result in a previously saved file. Use
+``--max-nodes`` to skip document sizes larger than the given number of nodes.
+"""
+
+import argparse
+import atexit
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from tweak import Config  # noqa
+
+Config._user_config_home, Config._user_cache_home = tempfile.mkdtemp(), tempfile.mkdtemp()
+atexit.register(shutil.rmtree, Config._user_config_home)
+atexit.register(shutil.rmtree, Config._user_cache_home)
+benchmarks = {}
+max_nodes = 1000000
+
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+
+def make_document(nodes, fanout=10):
+    """
+    Build a nested document of dicts with approximately the given number of nodes, with string and integer leaves.
+    """
+    counter = iter(range(nodes))
+
+    def make_level(depth):
+        doc = {}
+        for i in range(fanout):
+            n = next(counter, None)
+            if n is None:
+                break
+            if depth and i % 2 == 0:
+                doc["k%d" % i] = make_level(depth - 1)
+            else:
+                doc["k%d" % i] = "value %d" % n if i % 3 else n
+        return doc
+
+    depth, size = 0, fanout
+    while size < nodes:
+        depth, size = depth + 1, size * fanout
+    return make_level(depth + 1)
+
+
+def sizes_up_to(*sizes):
+    return [size for size in sizes if size <= max_nodes]
+
+
+def repeat_for(nodes):
+    return 3 if nodes > 100000 else 5 if nodes > 1000 else 20
+
+
+def timed(func, repeat=5):
+    """
+    Return the best wall clock time of several calls to func, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def config_file(doc, suffix=".json"):
+    """
+    Write doc to a temporary config file and point the TWEAK_BENCH config file variable at it.
+    """
+    fh = tempfile.NamedTemporaryFile("w", suffix=suffix)
+    if suffix == ".yml":
+        import yaml
+
+        yaml.safe_dump(doc, fh)
+    else:
+        json.dump(doc, fh)
+    fh.flush()
+    os.environ["TWEAK_BENCH_CONFIG_FILE"] = fh.name
+    return fh
+
+
+def load(**kwargs):
+    Config._parse_cache.clear()
+    return Config("TWEAK_BENCH", save_on_exit=False, **kwargs)
+
+
+def walk(value):
+    if hasattr(value, "items"):
+        for k, v in value.items():
+            walk(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            walk(v)
+
+
+def private_dirty_kb():
+    with open("/proc/self/smaps_rollup") as fh:
+        for line in fh:
+            if line.startswith("Private_Dirty:"):
+                return int(line.split()[1])
+
+
+def write_document(path, doc, use_yaml=False):
+    with open(path, "w") as fh:
+        if use_yaml:
+            import yaml
+
+            yaml.safe_dump(doc, fh)
+        else:
+            json.dump(doc, fh)
+
+
+@benchmark
+def construction(sizes=(10, 1000, 100000, 1000000)):
+    """
+    Time to construct a Config from two layered config files, the second of which includes three fragments, for JSON
+    and YAML documents of each size.
+    """
+    results = {}
+    for use_yaml in False, True:
+        suffix = ".yml" if use_yaml else ".json"
+        for nodes in sizes_up_to(*sizes):
+            config_dir = tempfile.mkdtemp()
+            atexit.register(shutil.rmtree, config_dir)
+            base, overlay = os.path.join(config_dir, "base" + suffix), os.path.join(config_dir, "overlay" + suffix)
+            write_document(base, make_document(nodes), use_yaml)
+            write_document(overlay, dict(make_document(nodes // 10), include="fragment*" + suffix), use_yaml)
+            for i in range(3):
+                write_document(os.path.join(config_dir, "fragment%d%s" % (i, suffix)), {"k%d" % i: i}, use_yaml)
+            os.environ["TWEAK_BENCH_CONFIG_FILE"] = base + ":" + overlay
+            label = "%s_%d_seconds" % ("yaml" if use_yaml else "json", nodes)
+            results[label] = timed(lambda: load(use_yaml=use_yaml, allow_includes=True), repeat_for(nodes))
+    return results
+
+
+@benchmark
+def access_depth(depths=(1, 2, 4, 8), count=100000):
+    """
+    Time per attribute access and per item access of a value nested at each depth, in nanoseconds.
+    """
+    results = {}
+    for depth in depths:
+        doc = value = {}
+        for _ in range(depth - 1):
+            value["a"] = value = {}
+        value["a"] = 1
+        config = Config("TWEAK_BENCH_ACCESS", save_on_exit=False)
+        config.update(doc)
+        attribute_access = eval("lambda config: config" + ".a" * depth)
+        item_access = eval("lambda config: config" + "['a']" * depth)
+        for label, access in ("attribute", attribute_access), ("item", item_access):
+            seconds = timed(lambda: [access(config) for _ in range(count)])
+            results["%s_depth_%d_ns" % (label, depth)] = seconds / count * 1e9
+    return results
+
+
+@benchmark
+def path_lookup(depths=(1, 2, 4, 8), count=100000):
+    """
+    Time per lookup of a value nested at each depth with chained attribute access and with get_path(), while the config
+    is unchanged and when it is modified before each lookup, in nanoseconds.
+    """
+    results = {}
+    for depth in depths:
+        doc = value = {}
+        for _ in range(depth - 1):
+            value["a"] = value = {}
+        value["a"] = 1
+        config = Config("TWEAK_BENCH_PATH", save_on_exit=False)
+        config.update(doc)
+        attribute_access = eval("lambda config: config" + ".a" * depth)
+        path = ".".join(["a"] * depth)
+
+        def modified_get_path():
+            config.x = 1
+            config.get_path(path)
+
+        results["attribute_depth_%d_ns" % depth] = timed(lambda: [attribute_access(config) for _ in range(count)])
+        results["get_path_depth_%d_ns" % depth] = timed(lambda: [config.get_path(path) for _ in range(count)])
+        results["modified_get_path_depth_%d_ns" % depth] = timed(lambda: [modified_get_path() for _ in range(count)])
+        for label in "attribute", "get_path", "modified_get_path":
+            results["%s_depth_%d_ns" % (label, depth)] *= 1e9 / count
+    return results
+
+
+@benchmark
+def typed_view(depths=(1, 2, 4, 8), count=100000):
+    """
+    Time per read of a value nested at each depth through a view returned by bind(), compared with chained attribute
+    access on the config, in nanoseconds, and time to bind the schema, in microseconds.
+    """
+    results = {}
+    for depth in depths:
+        doc = value = {}
+        for _ in range(depth - 1):
+            value["a"] = value = {}
+        value["a"] = "1"
+        schema = int
+        for level in range(depth):
+            schema = type("Level%d" % level, (), dict(__annotations__=dict(a=schema)))
+        config = Config("TWEAK_BENCH_VIEW", save_on_exit=False)
+        config.update(doc)
+        view = config.bind(schema)
+        access = eval("lambda value: value" + ".a" * depth)
+        results["bind_depth_%d_us" % depth] = timed(lambda: config.bind(schema)) * 1e6
+        results["attribute_depth_%d_ns" % depth] = timed(lambda: [access(config) for _ in range(count)]) * 1e9 / count
+        results["view_depth_%d_ns" % depth] = timed(lambda: [access(view) for _ in range(count)]) * 1e9 / count
+    return results
+
+
+@benchmark
+def update_directives(list_size=1000, count=10000):
+    """
+    Throughput of update() with a plain value, a nested mapping and each list merge directive, in updates per second.
+    """
+    updates = {
+        "set": lambda i: {"x": i},
+        "nested": lambda i: {"m": {"n": {"o": i}}},
+        "$append": lambda i: {"l": {"$append": i}},
+        "$extend": lambda i: {"l": {"$extend": [i, i]}},
+        "$insert": lambda i: {"l": {"$insert": {i % list_size: i}}},
+        "$extendleft": lambda i: {"l": {"$extendleft": [i]}},
+        "$remove": lambda i: {"l": {"$remove": i}},
+    }
+    results = {}
+    for label, make_update in updates.items():
+        config = Config("TWEAK_BENCH_UPDATE", save_on_exit=False)
+        config.update(l=list(range(list_size + count)), m={"n": {}})
+        arguments = [make_update(i) for i in range(count)]
+        results[label + "_per_second"] = count / timed(lambda: [config.update(a) for a in arguments], repeat=1)
+    return results
+
+
+@benchmark
+def save(sizes=(10, 1000, 100000, 1000000)):
+    """
+    Time taken by save() when nothing has changed, when a value has changed, and when the config was marked as changed
+    but its serialized contents are identical to the config file's, for JSON and YAML configs of each size.
+    """
+    results = {}
+    for use_yaml in False, True:
+        for nodes in sizes_up_to(*sizes):
+            config = Config("TWEAK_BENCH_SAVE", save_on_exit=False, use_yaml=use_yaml)
+            config.update(make_document(nodes), counter=0)
+            config.save()
+            label = "%s_%d_" % ("yaml" if use_yaml else "json", nodes)
+
+            def changed():
+                config.counter += 1
+                config.save()
+
+            def unchanged_contents():
+                config._dirty = True
+                config.save()
+
+            results[label + "clean_seconds"] = timed(config.save, repeat_for(nodes))
+            results[label + "changed_seconds"] = timed(changed, repeat_for(nodes))
+            results[label + "unchanged_contents_seconds"] = timed(unchanged_contents, repeat_for(nodes))
+            os.unlink(config.config_files[-1])
+    return results
+
+
+@benchmark
+def autosave_storm(nodes=1000, assignments=100):
+    """
+    Time to make many assignments to an autosaved config: saving after each assignment, with autosave_delay (including
+    the final flush), and within a single batch(), for JSON and YAML configs.
+    """
+    results = {}
+    for use_yaml in False, True:
+        for label, kwargs in ("immediate", {}), ("delayed", dict(autosave_delay=0.1)), ("batch", {}):
+            config = Config("TWEAK_BENCH_AUTOSAVE", save_on_exit=False, autosave=True, use_yaml=use_yaml, **kwargs)
+            config.update(make_document(nodes))
+
+            def storm():
+                with config.batch() if label == "batch" else contextlib.nullcontext():
+                    for i in range(assignments):
+                        config.counter = i
+                config.flush()
+
+            results["%s_%s_seconds" % ("yaml" if use_yaml else "json", label)] = timed(storm, repeat=3)
+            os.unlink(config.config_files[-1])
+    return results
+
+
+@benchmark
+def fork_rss(nodes=100000, workers=4):
+    """
+    Memory privately dirtied by each of several forked workers that read a whole config tree built before forking.
+    """
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        return {}
+    config = Config(save_on_exit=False)
+    config.update(make_document(nodes))
+    results = {}
+    for label, tree in ("config", config), ("frozen", config.freeze()):
+        gc.collect()
+        gc.freeze()
+        pipes = []
+        for _ in range(workers):
+            read_fd, write_fd = os.pipe()
+            if os.fork() == 0:
+                before = private_dirty_kb()
+                walk(tree)
+                os.write(write_fd, str(private_dirty_kb() - before).encode())
+                os._exit(0)
+            os.close(write_fd)
+            pipes.append(read_fd)
+        usage = []
+        for read_fd in pipes:
+            usage.append(int(os.read(read_fd, 64)))
+            os.close(read_fd)
+            os.wait()
+        gc.unfreeze()
+        results[label + "_private_dirty_kb"] = sum(usage) / len(usage)
+    return results
+
+
+@benchmark
+def load_100k(nodes=100000):
+    """
+    Time to construct a Config from a 100k-node JSON document, and the memory retained by the loaded tree.
+    """
+    with config_file(make_document(nodes)):
+        seconds = timed(load)
+        tracemalloc.start()
+        config = load()
+        Config._parse_cache.clear()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del config
+    return dict(load_seconds=seconds, retained_bytes=size)
+
+
+@benchmark
+def compiled_load(nodes=100000):
+    """
+    Time to construct a Config from a 100k-node JSON document and its include fragments, with and without a compiled
+    config.
+    """
+    doc = make_document(nodes)
+    doc.update(include="TWEAK_BENCH_FRAGMENTS/*.json", fragments=[])
+    with config_file(doc) as fh:
+        fragments_dir = os.path.join(os.path.dirname(fh.name), "TWEAK_BENCH_FRAGMENTS")
+        os.mkdir(fragments_dir)
+        atexit.register(shutil.rmtree, fragments_dir)
+        for i in range(10):
+            with open(os.path.join(fragments_dir, "%d.json" % i), "w") as fragment:
+                json.dump({"fragments": {"$append": i}, "fragment%d" % i: make_document(nodes // 10)}, fragment)
+        results = dict(load_seconds=timed(lambda: load(allow_includes=True)))
+        load(allow_includes=True).compile()
+        results["compiled_load_seconds"] = timed(lambda: load(allow_includes=True))
+        os.unlink(load().compiled_config_file)
+    return results
+
+
+@benchmark
+def partial_load(megabytes=50, sections=20):
+    """
+    Time and peak traced memory to construct a Config from a JSON config file of the given size, loading all of it and
+    loading only one small section with sections.
+    """
+    section_nodes = megabytes * 1000000 // 16 // sections
+    doc = {"section%d" % i: make_document(min(section_nodes, max_nodes)) for i in range(sections)}
+    doc["db"] = {"host": "example.com", "port": 5432}
+    with config_file(doc):
+        del doc
+        results = {}
+        for label, kwargs in ("full", {}), ("sections", dict(sections=["db"])):
+            results[label + "_load_seconds"] = timed(lambda: load(**kwargs), repeat=3)
+            tracemalloc.start()
+            config = load(**kwargs)
+            Config._parse_cache.clear()
+            results[label + "_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del config
+        results["file_bytes"] = os.path.getsize(os.environ["TWEAK_BENCH_CONFIG_FILE"])
+    return results
+
+
+@benchmark
+def diff(nodes=100000):
+    """
+    Time to diff two configs of the given size with cold digest caches, and after changing one value when the digests
+    of the rest of the configs are cached, compared with serializing both configs and comparing the results.
+    """
+    config, other = Config("TWEAK_BENCH_DIFF", save_on_exit=False), Config("TWEAK_BENCH_DIFF", save_on_exit=False)
+    config.update(make_document(nodes))
+    other.update(make_document(nodes))
+    results = dict(serialize_compare_seconds=timed(lambda: config._dump() == other._dump()))
+
+    def cold():
+        config._digests, other._digests = [None, {}], [None, {}]
+        config.diff(other)
+
+    def changed():
+        other.k0.k0.k0 = 0 if other.k0.k0.k0 else 1
+        config.diff(other)
+
+    results["cold_diff_seconds"] = timed(cold)
+    results["changed_diff_seconds"] = timed(changed)
+    return results
+
+
+@benchmark
+def layered_merge(nodes=100000, layers=5):
+    """
+    Merge throughput of update() when layering several large documents that override each other's keys and extend
+    each other's lists, in nodes per second.
+    """
+    documents = []
+    for i in range(layers):
+        doc = make_document(nodes)
+        doc["list"] = {"$extend": list(range(100))} if i else []
+        documents.append(doc)
+
+    def merge():
+        config = Config("TWEAK_BENCH_MERGE", save_on_exit=False)
+        for doc in documents:
+            config.update(doc)
+
+    return dict(nodes_per_second=nodes * layers / timed(merge))
+
+
+@benchmark
+def bulk_assign(nodes=100000):
+    """
+    Time to assign a large nested structure to a config key and then read every value in it, for a plain dict and for
+    a subtree of another config.
+    """
+    config = Config("TWEAK_BENCH_ASSIGN", save_on_exit=False)
+    source = Config("TWEAK_BENCH_ASSIGN_SOURCE", save_on_exit=False)
+    source.update(doc=make_document(nodes))
+    walk(source)
+    results = {}
+    for label, make_value in ("dict", lambda: make_document(nodes)), ("config", lambda: source.doc):
+        values = [make_value() for _ in range(5)]
+
+        def assign():
+            config.x = values.pop()
+
+        results[label + "_assign_seconds"] = timed(assign)
+        values = [make_value() for _ in range(5)]
+        results[label + "_assign_and_read_seconds"] = timed(lambda: (assign(), walk(config.x)))
+    return results
+
+
+@benchmark
+def json_backends(sizes=(10, 10000, 1000000)):
+    """
+    Load and save throughput for each installed JSON backend, in nodes per second.
+    """
+    results = {}
+    for nodes in sizes_up_to(*sizes):
+        with config_file(make_document(nodes)):
+            for backend in "json", "orjson", "ujson", "msgspec":
+                try:
+                    config = Config("TWEAK_BENCH_SAVE", save_on_exit=False, json_backend=backend)
+                except ImportError:
+                    continue
+                config.update(make_document(nodes))
+
+                def save():
+                    config._dirty = True
+                    config.save()
+                    os.unlink(config.config_files[-1])
+
+                repeat = 3 if nodes > 100000 else 20
+                results["%s_%d_load" % (backend, nodes)] = nodes / timed(lambda: load(json_backend=backend), repeat)
+                results["%s_%d_save" % (backend, nodes)] = nodes / timed(save, repeat)
+    return results
+
+
+@benchmark
+def yaml_backends(sizes=(10, 10000, 100000)):
+    """
+    YAML load and save throughput with the libyaml C bindings and with pure Python PyYAML, in nodes per second.
+    """
+    results = {}
+    for nodes in sizes_up_to(*sizes):
+        with config_file(make_document(nodes), suffix=".yml"):
+            for use_libyaml in True, False:
+                label = "libyaml" if use_libyaml else "python"
+                config = Config("TWEAK_BENCH_SAVE", save_on_exit=False, use_yaml=True, use_libyaml=use_libyaml)
+                config.update(make_document(nodes))
+
+                def save():
+                    config._dirty = True
+                    config.save()
+                    os.unlink(config.config_files[-1])
+
+                repeat = 3 if nodes > 1000 else 20
+                results["%s_%d_load" % (label, nodes)] = nodes / timed(
+                    lambda: load(use_yaml=True, use_libyaml=use_libyaml), repeat
+                )
+                results["%s_%d_save" % (label, nodes)] = nodes / timed(save, repeat)
+    return results
+
+
+@benchmark
+def parallel_includes(fragments=50, nodes=10000):
+    """
+    Time to construct a Config whose config file includes many fragments, reading them serially and on a thread pool.
+    """
+    results = {}
+    config_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, config_dir)
+    os.mkdir(os.path.join(config_dir, "conf.d"))
+    for i in range(fragments):
+        with open(os.path.join(config_dir, "conf.d", "%d.json" % i), "w") as fh:
+            json.dump({"fragment%d" % i: make_document(nodes)}, fh)
+    with open(os.path.join(config_dir, "config.json"), "w") as fh:
+        json.dump({"include": "conf.d/*.json"}, fh)
+    os.environ["TWEAK_BENCH_CONFIG_FILE"] = os.path.join(config_dir, "config.json")
+    for workers in 1, Config._load_workers:
+        Config._load_workers, default_workers = workers, Config._load_workers
+        results["%d_workers_load_seconds" % workers] = timed(lambda: load(allow_includes=True))
+        Config._load_workers = default_workers
+    return results
+
+
+@benchmark
+def threaded_reads(readers=4, writers=(0, 1), seconds=1.0):
+    """
+    Read throughput of several threads reading a shared config while other threads write to it, in reads per second,
+    with and without thread_safe.
+    """
+    results = {}
+    for thread_safe in False, True:
+        for writer_count in writers:
+            config = Config("TWEAK_BENCH_THREADS", save_on_exit=False, thread_safe=thread_safe)
+            config.update(make_document(1000), counter=0)
+            stop, counts = threading.Event(), []
+
+            def read():
+                n = 0
+                while not stop.is_set():
+                    config.k0.k1
+                    config.counter
+                    n += 1
+                counts.append(n)
+
+            def write():
+                while not stop.is_set():
+                    config.counter += 1
+
+            threads = [threading.Thread(target=read) for _ in range(readers)]
+            threads += [threading.Thread(target=write) for _ in range(writer_count)]
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            label = "%s_%d_writers" % ("thread_safe" if thread_safe else "unsafe", writer_count)
+            results[label + "_reads_per_second"] = sum(counts) / seconds
+    return results
+
+
+def compare(results, baseline):
+    """
+    Return the ratio of each result to the same result in the baseline.
+    """
+    ratios = {}
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if base:
+                ratios.setdefault(name, {})[metric] = value / base
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run: " + ", ".join(sorted(benchmarks)))
+    parser.add_argument("--max-nodes", type=int, default=max_nodes)
+    parser.add_argument("--output", help="Write the results to this file as well as to standard output")
+    parser.add_argument("--compare", help="Print ratios of the results to the results in this file")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("unknown benchmark " + name)
+    max_nodes = args.max_nodes
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    output = dict(commit=commit, python=platform.python_version(), results={})
+    for name in args.benchmarks or sorted(benchmarks):
+        output["results"][name] = benchmarks[name]()
+    if args.compare:
+        with open(args.compare) as fh:
+            output["ratios"] = compare(output["results"], json.load(fh)["results"])
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(output, fh, indent=2)
+    print(json.dumps(output, indent=2))
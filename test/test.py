@@ -1,22 +1,49 @@
 #!/usr/bin/env python
 
+import asyncio
+import copy
+import dataclasses
+import enum
+import gc
+import glob
 import json
 import logging
 import os
 import pickle
+import shutil
 import sys
 import tempfile
+import threading
+import time
+import typing
 import unittest
+import weakref
+from datetime import timedelta
+from unittest import mock
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from tweak import Config  # noqa
+import tweak  # noqa
+from tweak import Config, ConfigValidationError, _save_configs_on_exit  # noqa
+
+
+class TempConfig(Config):
+    pass
 
 
 class TestTweak(unittest.TestCase):
     def setUp(self):
         logging.basicConfig(level="DEBUG")
 
+    def make_config_class(self):
+        config_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_home)
+        for attr, path in ("_user_config_home", config_home), ("_user_cache_home", os.path.join(config_home, "cache")):
+            patcher = mock.patch.object(TempConfig, attr, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return TempConfig
+
     def test_basic_statements(self):
         config = Config()
         print(config)
@@ -65,7 +92,7 @@ class TestTweak(unittest.TestCase):
         self.assertEqual(config.foo, 1)
 
     def test_merge(self):
-        config = Config()
+        config = self.make_config_class()(save_on_exit=False)
         config.update({})
         config.update({"m": {"i": 1}})
         self.assertEqual(config["m"], {"i": 1})
@@ -87,6 +114,21 @@ class TestTweak(unittest.TestCase):
         self.assertEqual(config["m"], {"i": 1, "j": [7, 8], "k": [5, "z", "z", "v", "v", "z", "z"]})
         config.update({"m": {"k": {"$remove": "z"}}})
         self.assertEqual(config["m"], {"i": 1, "j": [7, 8], "k": [5, "z", "v", "v", "z", "z"]})
+        defaults = {"db": {"host": "x"}, "hosts": [{"name": "a"}]}
+        config.update(defaults)
+        config.db.host, config.hosts[0].name = "y", "b"
+        config.hosts.append({})
+        self.assertEqual(defaults, {"db": {"host": "x"}, "hosts": [{"name": "a"}]})
+
+    def test_update_copies_aliases(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_aliases")
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, "config.yml"), "w") as fh:
+            fh.write("base: &b {timeout: 1}\nsvc: *b\n")
+        config = config_class("test_aliases", save_on_exit=False, use_yaml=True)
+        config.svc.timeout = 5
+        self.assertEqual(config.base.timeout, 1)
 
     def test_ingest(self):
         with tempfile.NamedTemporaryFile("w") as cf1, tempfile.NamedTemporaryFile("w") as cf2:
@@ -129,6 +171,825 @@ class TestTweak(unittest.TestCase):
             self.assertEqual(dict(config), {'x': list(range(8)), 'z': {'null': None}, 't': 4.5, 'include': incl_expr})
             self.assertEqual(len(config.config_files), 3)
 
+    def test_autosave_batch(self):
+        config = self.make_config_class()(autosave=True, save_on_exit=False)
+        with config.batch():
+            for i in range(100):
+                config["k%d" % i] = i
+            with config.batch():
+                config.nested = dict(x=1)
+                config.nested.y = 2
+            self.assertFalse(os.path.exists(config.config_files[-1]))
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(len(json.load(fh)), 101)
+
+    def test_autosave_delay(self):
+        config = self.make_config_class()(autosave=True, autosave_delay=60, save_on_exit=False)
+        config.x, config.y = 1, 2
+        self.assertFalse(os.path.exists(config.config_files[-1]))
+        self.assertEqual(pickle.loads(pickle.dumps(config)).x, 1)
+        config.flush()
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(json.load(fh), dict(x=1, y=2))
+        self.assertIsNone(config._save_timer)
+
+    def test_autosave_delay_racing_writes(self):
+        config_class = self.make_config_class()
+        for trial in range(10):
+            config = config_class(autosave=True, autosave_delay=0.0005, save_on_exit=False)
+            for i in range(3000):
+                config.k = i
+            time.sleep(0.01)
+            config.flush()
+            self.assertFalse(config._dirty)
+            with open(config.config_files[-1]) as fh:
+                self.assertEqual(json.load(fh), dict(k=2999))
+
+    def test_dirty_tracking(self):
+        config_class = self.make_config_class()
+        config = config_class(save_on_exit=False)
+        config.update(x=[1, 2], y={"z": [3]})
+        config.save()
+        config = config_class(save_on_exit=False)
+        with mock.patch.object(config_class, "_dump") as dump:
+            config.save()
+            self.assertFalse(dump.called)
+        for mutate in (
+            lambda: config.x.append(3),
+            lambda: config.update(x={"$extendleft": [0]}),
+            lambda: config.y.z.sort(),
+            lambda: config.y.update(w=1),
+            lambda: config.__delitem__("y"),
+        ):
+            mutate()
+            self.assertTrue(config._dirty)
+            config.save()
+            self.assertFalse(config._dirty)
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(json.load(fh), dict(x=[0, 1, 2, 3]))
+        config = pickle.loads(pickle.dumps(config))
+        config.x.pop()
+        self.assertTrue(config._dirty)
+
+    def test_atomic_save(self):
+        config = self.make_config_class()(save_on_exit=False)
+        config.x = 1
+        config.save(mode=0o640)
+        config_dir = os.path.dirname(config.config_files[-1])
+        self.assertEqual(os.listdir(config_dir), ["config.json"])
+        self.assertEqual(os.stat(config.config_files[-1]).st_mode & 0o777, 0o640)
+        config.x = 2
+        with mock.patch("os.fsync", side_effect=OSError(28, "No space left on device")):
+            with self.assertRaises(OSError):
+                config.save()
+        self.assertEqual(os.listdir(config_dir), ["config.json"])
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(json.load(fh), dict(x=1))
+        config.save()
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(json.load(fh), dict(x=2))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_locking_save_from_many_processes(self):
+        config_class, workers, rounds = self.make_config_class(), 16, 5
+        config = config_class(save_on_exit=False)
+        config.update(common={"x": 0}, removed=True)
+        config.save()
+        pids = []
+        for worker in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    config = config_class(save_on_exit=False, locking=True)
+                    if worker == 0:
+                        del config["removed"]
+                    for i in range(rounds):
+                        config["w%d_%d" % (worker, i)] = i
+                        config.common["w%d_%d" % (worker, i)] = i
+                        config.save()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        config = config_class(save_on_exit=False)
+        expect = {"w%d_%d" % (worker, i): i for worker in range(workers) for i in range(rounds)}
+        self.assertEqual(config.common, dict(expect, x=0))
+        self.assertEqual(dict(config), dict(expect, common=config.common))
+
+    def test_parse_cache(self):
+        with tempfile.NamedTemporaryFile("w") as cf:
+            json.dump(dict(x=[{"y": 1}]), cf)
+            cf.flush()
+            os.environ["TWEAK_CACHE_TEST_CONFIG_FILE"] = cf.name
+            with mock.patch.object(Config, "_parse", autospec=True, side_effect=Config._parse) as parse:
+                for i in range(3):
+                    config = Config("TWEAK_CACHE_TEST", save_on_exit=False)
+                    self.assertEqual(config.x[0].y, 1)
+                    config.x[0].y = 2
+                self.assertEqual(parse.call_count, 1)
+                cf.seek(0)
+                json.dump(dict(x=[{"y": 3}]), cf)
+                cf.flush()
+                os.utime(cf.name, ns=(0, 0))
+                self.assertEqual(Config("TWEAK_CACHE_TEST", save_on_exit=False).x[0].y, 3)
+                self.assertEqual(parse.call_count, 2)
+                Config("TWEAK_CACHE_TEST", save_on_exit=False, parse_cache=False)
+                self.assertEqual(parse.call_count, 3)
+
+    def test_parse_cache_eviction(self):
+        cache = tweak._ParseCache()
+        cache.put("a", 1, b"12345", max_size=10)
+        self.assertEqual(cache.get("a", 1), b"12345")
+        self.assertIsNone(cache.get("a", 2))
+        self.assertEqual(len(cache), 0)
+        cache.put("a", 1, b"12345", max_size=10)
+        cache.put("b", 1, b"1234", max_size=10)
+        cache.get("a", 1)
+        cache.put("c", 1, b"123", max_size=10)
+        self.assertEqual((cache.get("a", 1), cache.get("b", 1), cache.get("c", 1)), (b"12345", None, b"123"))
+        cache.put("d", 1, b"12345678901", max_size=10)
+        self.assertEqual(len(cache), 2)
+        config_class = self.make_config_class()
+        with mock.patch.object(config_class, "_parse_cache", cache), mock.patch.object(
+            config_class, "_parse_cache_max_size", 100
+        ):
+            cache.clear()
+            for name in "cache1", "cache2":
+                os.makedirs(os.path.join(config_class._user_config_home, name))
+                with open(os.path.join(config_class._user_config_home, name, "config.json"), "w") as fh:
+                    json.dump(dict(x="x" * 60), fh)
+                self.assertEqual(config_class(name, save_on_exit=False).x, "x" * 60)
+            self.assertEqual(len(cache), 1)
+            config_class("cache2", save_on_exit=False, parse_cache=False)
+            config_class("cache3", save_on_exit=False, parse_cache=False)
+            self.assertEqual(len(cache), 1)
+
+    def test_freeze(self):
+        config = Config(save_on_exit=False)
+        config.frozen = {"x": {"y": [1, {"z": 2}]}}
+        frozen = config.freeze()
+        self.assertEqual(frozen.frozen.x.y[1].z, 2)
+        self.assertEqual(frozen["frozen"]["x"]["y"], (1, {"z": 2}))
+        self.assertEqual(pickle.loads(pickle.dumps(frozen)), frozen)
+        with self.assertRaises(AttributeError):
+            frozen.frozen.x = 1
+        with self.assertRaises(TypeError):
+            frozen.frozen["x"] = 1
+        config.frozen.x = 1
+        self.assertEqual(frozen.frozen.x.y[0], 1)
+
+    def test_nested_nodes(self):
+        config = self.make_config_class()(save_on_exit=False, autosave=False)
+        config.update(a={"b": {"c": [1]}})
+        self.assertIsInstance(config.a.b, Config)
+        self.assertFalse(hasattr(config.a.b, "__dict__"))
+        self.assertIs(config.a.b._root, config)
+        node = pickle.loads(pickle.dumps(config.a))
+        self.assertEqual(node, {"b": {"c": [1]}})
+        node.b.c.append(2)
+        self.assertTrue(node._root._dirty)
+
+    def test_lazy_nodes(self):
+        with tempfile.NamedTemporaryFile("w") as cf:
+            json.dump(dict(a={"b": {"c": 1}}, d=[{"e": [2]}], f={"g": {"$append": 3}}), cf)
+            cf.flush()
+            os.environ["TWEAK_LAZY_TEST_CONFIG_FILE"] = cf.name
+            config = Config("TWEAK_LAZY_TEST", save_on_exit=False)
+            self.assertIs(type(config._data["a"]), dict)
+            self.assertIs(config.a, config.a)
+            self.assertIs(type(config.a._data["b"]), dict)
+            self.assertEqual(config.a.b.c, 1)
+            self.assertEqual([item.e for item in config.d], [[2]])
+            config.d[0].e.append(3)
+            self.assertTrue(config._dirty)
+            self.assertEqual(config.f, {})
+            self.assertEqual(json.loads(config._dump()), dict(a={"b": {"c": 1}}, d=[{"e": [2, 3]}], f={}))
+
+    def test_assign_config_values(self):
+        config_class = self.make_config_class()
+        config, other = config_class("config", save_on_exit=False), config_class("other", save_on_exit=False)
+        other.update(y={"z": [{"w": 1}]})
+        plain = {"a": {"b": 1}}
+        config.plain = plain
+        self.assertIs(config._data["plain"], plain)
+        self.assertEqual(config.plain.a.b, 1)
+        config.x = other.y
+        config.n = {"m": [other.y.z, config.plain.a]}
+        self.assertIs(type(config._data["x"]), dict)
+        self.assertIs(type(config._data["n"]["m"][0][0]), dict)
+        config.f = other.freeze()
+        config.l = [config.x.z[0]]
+        config.l.append(other.y)
+        config.x.z[0].w = 2
+        config.n.m[1].b = 3
+        self.assertEqual(other, {"y": {"z": [{"w": 1}]}})
+        self.assertEqual(config.plain.a.b, 1)
+        self.assertEqual(config.x.z[0]._path, ("x", "z", None))
+        self.assertIs(config.n.m[1]._root, config)
+        self.assertEqual(config.f, {"y": {"z": [{"w": 1}]}})
+        self.assertEqual(config.l, [{"w": 1}, {"z": [{"w": 1}]}])
+        config.t = ({"a": (1, 2)}, other.freeze().y)
+        self.assertEqual(config.t, [{"a": [1, 2]}, {"z": [{"w": 1}]}])
+        config.save()
+        self.assertEqual(config_class("config", save_on_exit=False), config)
+        yaml_config = config_class("config", save_on_exit=False, use_yaml=True)
+        yaml_config.update(f=other.freeze(), t=(other.freeze().y,))
+        yaml_config.save()
+        self.assertEqual(config_class("config", save_on_exit=False, use_yaml=True), yaml_config)
+
+    def test_json_backends(self):
+        config_class = self.make_config_class()
+        for backend in "json", "orjson", "ujson", "msgspec":
+            try:
+                config = config_class(save_on_exit=False, json_backend=backend)
+            except ImportError:
+                continue
+            config.update(x={"y": [1, {"z": "т"}]}, n=None)
+            config.save()
+            self.assertEqual(dict(config_class(save_on_exit=False, json_backend="json")), dict(config))
+            os.unlink(config.config_files[-1])
+        with self.assertRaises(ValueError):
+            config_class(json_backend="yaml")
+        with open(config.config_files[-1], "w") as fh:
+            json.dump({"keep": 1, "ratio": float("nan"), "limits": [float("inf"), -float("inf")], "big": 2**70}, fh)
+        for backend in None, "json", "orjson", "ujson", "msgspec":
+            try:
+                config = config_class(save_on_exit=False, json_backend=backend)
+            except ImportError:
+                continue
+            self.assertEqual(config.keep, 1)
+            self.assertNotEqual(config.ratio, config.ratio)
+            self.assertEqual(config.limits, [float("inf"), -float("inf")])
+            self.assertEqual(config.big, 2**70)
+            config.big += 1
+            config.save()
+            with open(config.config_files[-1]) as fh:
+                saved = json.load(fh)
+            self.assertEqual(saved["limits"], [float("inf"), -float("inf")])
+            self.assertEqual(saved["big"], 2**70 + 1)
+            config.big -= 1
+            config.save()
+
+    def test_yaml_codecs(self):
+        config_class = self.make_config_class()
+        for use_libyaml in True, False:
+            config = config_class(save_on_exit=False, use_yaml=True, use_libyaml=use_libyaml)
+            config.update(x={"y": [1, {"z": "т"}]}, n=None)
+            config.save()
+            self.assertEqual(dict(config_class(save_on_exit=False, use_yaml=True)), dict(config))
+            os.unlink(config.config_files[-1])
+            config = config_class(save_on_exit=False, use_yaml=True, use_libyaml=use_libyaml)
+            config.update(z=1, top={"b": 1, "a": {"d": 1, "c": 2}})
+            unread = config._dump()
+            config.top.a.c
+            self.assertEqual(config._dump(), unread)
+            self.assertEqual(unread, "z: 1\ntop:\n  b: 1\n  a:\n    d: 1\n    c: 2\n")
+        import tweak
+
+        self.assertIs(tweak._yaml_codec(False)[1], tweak._yaml_codec(False)[1])
+
+    def test_journal(self):
+        config_class = self.make_config_class()
+        config = config_class(save_on_exit=False, journal=True)
+        config.update(x={"y": [1, 2]}, z=[{"w": 1}], d=1)
+        config.save()
+        config.update(x={"y": {"$extendleft": [0]}})
+        config.update(x={"y": {"$insert": {1: 0.5}}})
+        config.update(x={"y": {"$remove": 2}})
+        config.x.y.append(3)
+        config.x.y.extend([4])
+        config.x.y.sort(reverse=True)
+        config.z[0].w = 2
+        config.z[0]["v"] = [3]
+        config.z[0].v.pop()
+        del config["d"]
+        config.save()
+        self.assertFalse(os.path.exists(config.config_files[-1]))
+        expect = dict(x={"y": [4, 3, 1, 0.5, 0]}, z=[{"w": 2, "v": []}])
+        self.assertEqual(config, expect)
+        self.assertEqual(config_class(save_on_exit=False), expect)
+        with mock.patch.object(config_class, "_journal_max_size", 0):
+            config.x.y = []
+            config.save()
+        self.assertFalse(os.path.exists(config.config_files[-1] + ".journal"))
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(json.load(fh), dict(expect, x={"y": []}))
+        config.x.y = [1]
+        config.save()
+        config = config_class(save_on_exit=False)
+        self.assertEqual(config.x.y, [1])
+        config.x.y = [2]
+        config.save()
+        self.assertEqual(config_class(save_on_exit=False).x.y, [2])
+        journaled = config_class(save_on_exit=False, journal=True)
+        journaled.a = 1
+        journaled.save()
+        other = config_class(save_on_exit=False)
+        other.b = 2
+        other.save()
+        journaled.c = 3
+        journaled.save()
+        self.assertEqual(config_class(save_on_exit=False).c, 3)
+        journaled.d = 4
+        journaled.save()
+        self.assertTrue(os.path.exists(config.config_files[-1] + ".journal"))
+        self.assertEqual(config_class(save_on_exit=False).d, 4)
+        journaled.x = [1]
+        with mock.patch.object(config_class, "_journal_max_size", 0):
+            journaled.save()
+        journaled.x.append(2)
+        journaled.save()
+        other = config_class(save_on_exit=False)
+        self.assertEqual(other.x, [1, 2])
+        other.x.remove(2)
+        other.save()
+        self.assertEqual(config_class(save_on_exit=False).x, [1])
+        with self.assertRaises(ValueError):
+            config_class(journal=True, locking=True)
+
+    def test_merge_directives(self):
+        config_class = self.make_config_class()
+
+        def set_default(config, key, value):
+            config.setdefault(key, value)
+
+        with mock.patch.dict(config_class.merge_directives, {"$default": set_default}):
+            config = config_class(save_on_exit=False, autosave=True)
+            with mock.patch.object(config_class, "save", autospec=True) as save:
+                config.update({"a": {"b": [1], "c": 1, "d": {"e": 1}}}, f=1)
+                config.update([("a", {"b": {"$append": 2}, "c": {"$default": 2}, "g": {"$default": 3}})])
+                config.update(a={"c": {"x": 1}, "d": {"e": {"$extend": [1]}}}, f={"y": 2})
+            self.assertEqual(save.call_count, 3)
+        self.assertEqual(config, {"a": {"b": [1, 2], "c": {"x": 1}, "d": {"e": 1}, "g": 3}, "f": {"y": 2}})
+        with self.assertRaises(TypeError):
+            config.update({}, {})
+
+    def test_parallel_load(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_parallel_load")
+        os.makedirs(os.path.join(config_dir, "conf.d", "nested"))
+        documents = {"config.json": dict(a=0, include=["conf.d/*.json", "missing/*.json"])}
+        for i in range(20):
+            documents["conf.d/%02d.json" % i] = dict(a=i, n={str(i): i, "last": i}, l={"$append": i})
+        documents["conf.d/00.json"].update(l=[], include="nested/*.json")
+        documents["conf.d/nested/x.json"] = dict(a="nested", n={"nested": True})
+        for path, contents in documents.items():
+            with open(os.path.join(config_dir, path), "w") as fh:
+                json.dump(contents, fh)
+        with open(os.path.join(config_dir, "conf.d", "broken.json"), "w") as fh:
+            fh.write("{")
+        configs = []
+        for workers in 1, 8:
+            with mock.patch.object(config_class, "_load_workers", workers):
+                config = config_class("test_parallel_load", save_on_exit=False, allow_includes=True)
+            configs.append((config, config._include_patterns, len(config._load_errors)))
+        self.assertEqual(configs[0], configs[1])
+        self.assertEqual(len(configs[1][0].n), 22)
+        self.assertEqual(configs[1][2], 1)
+
+    def test_compile(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_compile")
+        os.makedirs(os.path.join(config_dir, "conf.d"))
+        with open(os.path.join(config_dir, "config.json"), "w") as fh:
+            json.dump(dict(x=[1], include="conf.d/*.json"), fh)
+        with open(os.path.join(config_dir, "conf.d", "1.json"), "w") as fh:
+            json.dump(dict(x=[0], y={"z": 1}), fh)
+        config = config_class("test_compile", save_on_exit=False, allow_includes=True)
+        self.assertEqual(config.compile(), config.compiled_config_file)
+        with mock.patch.object(config_class, "_merge_config_file", side_effect=AssertionError):
+            compiled = config_class("test_compile", save_on_exit=False, allow_includes=True)
+            self.assertEqual(compiled, config)
+            self.assertEqual(compiled, {"x": [1], "y": {"z": 1}})
+        self.assertNotIn("y", config_class("test_compile", save_on_exit=False))
+        with open(os.path.join(config_dir, "conf.d", "2.json"), "w") as fh:
+            json.dump(dict(w=1), fh)
+        self.assertEqual(config_class("test_compile", save_on_exit=False, allow_includes=True).w, 1)
+        config.compile()
+        compiled.y.z = 2
+        compiled.save()
+        self.assertEqual(config_class("test_compile", save_on_exit=False, allow_includes=True).y.z, 2)
+
+    def test_instrument(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_instrument")
+        os.makedirs(os.path.join(config_dir, "conf.d"))
+        with open(os.path.join(config_dir, "config.json"), "w") as fh:
+            json.dump(dict(x=1, include="conf.d/*.json"), fh)
+        for i in range(2):
+            with open(os.path.join(config_dir, "conf.d", "%d.json" % i), "w") as fh:
+                json.dump({"y%d" % i: i}, fh)
+        self.assertIsNone(config_class("test_instrument", save_on_exit=False).stats)
+        events = []
+        config = config_class(
+            "test_instrument", save_on_exit=False, allow_includes=True, instrument=lambda *args: events.append(args[1:])
+        )
+        config_file = config.config_files[1]
+        self.assertEqual([event for event, data in events], ["parse", "include"] + ["parse", "merge"] * 2 + ["merge"])
+        pattern = os.path.join(config_dir, "conf.d/*.json")
+        self.assertEqual(events[1][1], dict(path=config_file, pattern=pattern, files=2))
+        stats = config.stats
+        self.assertEqual(stats.parse_bytes[config_file], os.stat(config_file).st_size)
+        self.assertEqual(sorted(stats.merge_seconds), sorted([config_file] + glob.glob(config_dir + "/conf.d/*")))
+        config.save()
+        config.x = 2
+        config.save()
+        config.x = 2
+        config.save()
+        self.assertEqual((stats.saves, stats.clean_saves, stats.writes, stats.unchanged_writes), (3, 1, 1, 1))
+        self.assertGreater(stats.serialize_seconds, 0)
+        self.assertEqual(events[-1][0], "write")
+
+    def test_reload(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_reload")
+        os.makedirs(os.path.join(config_dir, "conf.d"))
+
+        def write(path, contents):
+            with open(os.path.join(config_dir, path), "w") as fh:
+                json.dump(contents, fh)
+
+        write("config.json", dict(a=1, b=dict(c=1, d=2), include="conf.d/*.json"))
+        write("conf.d/x.json", dict(e=1))
+        config = config_class("test_reload", save_on_exit=False, allow_includes=True)
+        config.local = 1
+        self.assertEqual(config.reload(), [("local",)])
+        self.assertNotIn("local", config)
+        config.local = 1
+        b = config.b
+        changes = []
+        config.watch(lambda config, paths: changes.extend(paths), interval=0.05)
+        write("config.json", dict(b=dict(c=5, d=2), include="conf.d/*.json"))
+        write("conf.d/y.json", dict(f=2))
+        for _ in range(100):
+            if len(changes) >= 3:
+                break
+            time.sleep(0.05)
+        config.unwatch()
+        self.assertEqual(sorted(changes), [("a",), ("b", "c"), ("f",)])
+        self.assertEqual(config, dict(b=dict(c=5, d=2), e=1, f=2, local=1))
+        self.assertEqual(b.c, 5)
+        write("conf.d/y.json", dict(f=3))
+        self.assertEqual(config.reload(), [("f",)])
+        self.assertEqual(config.f, 3)
+        self.assertEqual(pickle.loads(pickle.dumps(config)), config)
+        del changes[:]
+        config.watch(lambda config, paths: changes.extend(paths), interval=0.05)
+        config.x = 1
+        config.save()
+        config.x = 2
+        self.assertEqual(config.reload(), [])
+        self.assertEqual(config.x, 2)
+        time.sleep(0.2)
+        config.unwatch()
+        self.assertEqual(changes, [])
+        self.assertEqual(config.x, 2)
+
+    def test_reload_while_reading(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_reload_reads")
+        os.makedirs(config_dir)
+        config = config_class("test_reload_reads", save_on_exit=False)
+        config.watch(interval=60)
+        config.unwatch()
+        errors, stop = [], threading.Event()
+
+        def reload():
+            for n in range(200):
+                with open(os.path.join(config_dir, "config.json"), "w") as fh:
+                    json.dump({"k%d" % i: {"n": n} for i in range(n % 2, 40, 2)}, fh)
+                config.reload()
+            stop.set()
+
+        def read():
+            try:
+                while not stop.is_set():
+                    dict(config.items())
+                    list(config.values())
+                    for key in config:
+                        config.get(key)
+            except Exception as e:
+                errors.append(e)
+
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-5)
+        threads = [threading.Thread(target=reload), threading.Thread(target=read), threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_thread_safe(self):
+        config = self.make_config_class()(save_on_exit=False, thread_safe=True, json_backend="json")
+        config.update(pair={"a": 0, "b": 0}, entries=[], counts={})
+        errors, reads, stop = [], [], threading.Event()
+
+        def read():
+            n = 0
+            try:
+                while not stop.is_set():
+                    pair = config.pair
+                    self.assertEqual(pair["a"], pair["b"])
+                    for i in range(4):
+                        config.get("writer%d" % i)
+                    len(config.entries)
+                    dict(config.counts.items())
+                    dict(config.items())
+                    list(config.values())
+                    n += 1
+            except Exception as e:
+                errors.append(e)
+            reads.append(n)
+
+        def write(i):
+            try:
+                for n in range(50):
+                    config.pair = {"a": n, "b": n}
+                    config["writer%d" % i] = {"n": n}
+                    config.entries.append({"writer": i})
+                    config.update(counts={"%d-%d" % (i, n): n})
+                    config["scratch%d" % i] = {"n": n}
+                    del config["scratch%d" % i]
+                    config.counts["scratch%d" % i] = n
+                    config.counts.pop("scratch%d" % i)
+                    if n % 10 == 0:
+                        config.save()
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-5)
+        writers = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(all(reads))
+        self.assertEqual(len(config.entries), 200)
+        self.assertEqual(len(config.counts), 200)
+        self.assertEqual([config["writer%d" % i] for i in range(4)], [{"n": 49}] * 4)
+        config.save()
+        with open(config.config_files[-1]) as fh:
+            self.assertEqual(json.load(fh), config)
+        self.assertEqual(pickle.loads(pickle.dumps(config)), config)
+
+    def test_asave(self):
+        config_class = self.make_config_class()
+
+        async def autosave():
+            config = config_class(save_on_exit=False, autosave=True, async_save=True)
+            for i in range(100):
+                config.x = i
+            self.assertFalse(os.path.exists(config.config_files[-1]))
+            await config.asave()
+            return config
+
+        with mock.patch.object(
+            config_class, "_save_contents", autospec=True, side_effect=Config._save_contents
+        ) as save:
+            config = asyncio.run(autosave())
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(config_class(save_on_exit=False).x, 99)
+
+        async def concurrent_asave(config):
+            saves = []
+            for i in range(10):
+                config.y = i
+                saves.extend(asyncio.ensure_future(config.asave()) for _ in range(5))
+            await asyncio.gather(*saves)
+
+        for kwargs in {}, dict(locking=True), dict(journal=True):
+            config = config_class(save_on_exit=False, **kwargs)
+            with mock.patch.object(config_class, "_make_config_dir", autospec=True) as make_config_dir:
+                asyncio.run(concurrent_asave(config))
+            self.assertLessEqual(make_config_dir.call_count, 2)
+            self.assertFalse(config._dirty)
+            self.assertEqual(config_class(save_on_exit=False).y, 9)
+
+    def test_get_path(self):
+        config = self.make_config_class()(save_on_exit=False)
+        config.update(services={"db": {"primary": {"host": "a", "ports": [1, {"tls": 2}]}}}, x=1)
+        self.assertEqual(config.get_path("services.db.primary.host"), "a")
+        self.assertEqual(config.get_path(["services", "db", "primary", "ports", 1, "tls"]), 2)
+        self.assertEqual(config.get_path("services.db.primary.ports.1.tls"), 2)
+        self.assertIs(config.get_path("services.db"), config.services.db)
+        self.assertEqual(config.services.get_path("db.primary.host"), "a")
+        for path in "services.db.replica", "x.y", "services.db.primary.ports.5", "services.db.primary.ports.tls", "":
+            self.assertIsNone(config.get_path(path))
+        self.assertEqual(config.get_path("x.y", default=0), 0)
+        config.services.db.primary.host = "b"
+        self.assertEqual(config.get_path("services.db.primary.host"), "b")
+        config.services.db.primary.ports[1] = 3
+        self.assertEqual(config.get_path("services.db.primary.ports.1"), 3)
+        del config.services["db"]
+        self.assertIsNone(config.get_path("services.db.primary.host"))
+        config.set_path("services.db.primary.host", "c")
+        config.set_path(("x", "y"), 2)
+        config.set_path("services.db.primary.ports", [0])
+        config.set_path("services.db.primary.ports.0", 4)
+        self.assertEqual(config, dict(services={"db": {"primary": {"host": "c", "ports": [4]}}}, x={"y": 2}))
+        config.update(x={"z": 1})
+        self.assertEqual(config.get_path("x.z"), 1)
+        config.lst = [{"name": "a"}, {"name": "b"}]
+        self.assertEqual(config.lst[0].get_path("name"), "a")
+        self.assertEqual(config.lst[1].get_path("name"), "b")
+        self.assertEqual(config.get_path("lst.1.name"), "b")
+
+    def test_sections(self):
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_sections")
+        os.makedirs(os.path.join(config_dir, "conf.d"))
+        big = {"a": [{"b": "]}\\\"{["}] * 100, "c": None}
+        with open(os.path.join(config_dir, "config.json"), "w") as fh:
+            json.dump({"big": big, "db": {"host": "a"}, "include": "conf.d/*.json", "cache": [1]}, fh, indent=2)
+        with open(os.path.join(config_dir, "conf.d", "1.json"), "w") as fh:
+            json.dump({"db": {"host": "b", "port": 1}, "big": {}}, fh)
+        for use_yaml in False, True:
+            if use_yaml:
+                with open(os.path.join(config_dir, "config.json")) as fh, open(fh.name[:-4] + "yml", "w") as yml:
+                    json.dump(json.load(fh), yml)
+            config = config_class(
+                "test_sections", save_on_exit=False, use_yaml=use_yaml, allow_includes=True, sections=["db", "cache"]
+            )
+            self.assertEqual(config, {"db": {"host": "a", "port": 1}, "cache": [1]})
+        self.assertEqual(config_class("test_sections", save_on_exit=False, sections=["big"]), {"big": big})
+        config = config_class("test_sections", save_on_exit=False, sections=["db", "x"])
+        config.db.host, config.x = "c", 1
+        config.save()
+        with open(os.path.join(config_dir, "config.json")) as fh:
+            on_disk = json.load(fh)
+        self.assertEqual(on_disk, {"big": big, "db": {"host": "c"}, "include": "conf.d/*.json", "cache": [1], "x": 1})
+        config_class("test_sections", save_on_exit=False, allow_includes=True, sections=["cache"]).compile()
+        with self.assertLogs("tweak", "INFO") as logs:
+            partial = config_class("test_sections", save_on_exit=False, allow_includes=True, sections=["db"])
+        self.assertEqual(partial, {"db": {"host": "c", "port": 1}})
+        self.assertIn("Loaded compiled configuration", logs.output[0])
+        self.assertEqual(len(config_class("test_sections", save_on_exit=False, allow_includes=True)), 4)
+        for contents in "", "[]", '{"db": 1', '{"db" 1}':
+            with open(os.path.join(config_dir, "config.json"), "w") as fh:
+                fh.write(contents)
+            self.assertEqual(config_class("test_sections", save_on_exit=False, sections=["db"]), {})
+        with open(os.path.join(config_dir, "config.json"), "w") as fh:
+            fh.write('{"skip": [' + '1, "a", {"b": [2]}, ' * 100000)
+        start = time.perf_counter()
+        self.assertEqual(config_class("test_sections", save_on_exit=False, sections=["db"]), {})
+        self.assertLess(time.perf_counter() - start, 5)
+        with self.assertRaises(ValueError):
+            config_class(journal=True, sections=["db"])
+
+    def test_diff(self):
+        config_class = self.make_config_class()
+        config, other = config_class("config", save_on_exit=False), config_class("other", save_on_exit=False)
+        doc = {"s%d" % i: {"t%d" % j: {"x": j, "l": [j, {"y": j}]} for j in range(10)} for i in range(10)}
+        config.update(doc)
+        other.update(copy.deepcopy(doc))
+        snapshot = other.freeze()
+        with mock.patch("tweak._digest", side_effect=tweak._digest) as digest:
+            self.assertEqual(config.diff(other), {"$set": [], "$delete": []})
+        full_diff_calls = digest.call_count
+        other.s1.t2.x = "2"
+        other.s3.t4.l.append(1)
+        del other.s5["t6"]
+        other.set_path("s7.t8.z", {"w": 1})
+        other.s9, other.n = 9, [1]
+        with mock.patch("tweak._digest", side_effect=tweak._digest) as digest:
+            delta = config.diff(other)
+        self.assertLess(digest.call_count, full_diff_calls / 4)
+        expect = [
+            [["s1", "t2", "x"], "2"],
+            [["s3", "t4", "l"], [4, {"y": 4}, 1]],
+            [["s7", "t8", "z"], {"w": 1}],
+            [["s9"], 9],
+            [["n"], [1]],
+        ]
+        self.assertEqual(delta, {"$set": expect, "$delete": [["s5", "t6"]]})
+        self.assertEqual(config.diff(snapshot), {"$set": [], "$delete": []})
+        self.assertEqual(other.s7.diff(config.s7), {"$set": [], "$delete": [["t8", "z"]]})
+        config.patch(json.loads(json.dumps(delta)))
+        self.assertEqual(config, other)
+        self.assertEqual(config.diff(other), {"$set": [], "$delete": []})
+        self.assertEqual(other.diff(snapshot)["$delete"], [["s7", "t8", "z"], ["n"]])
+        other.patch(other.diff(snapshot))
+        self.assertEqual(other.diff(snapshot), {"$set": [], "$delete": []})
+
+    def test_bind(self):
+        class Mode(enum.Enum):
+            fast, safe = "fast", "safe"
+
+        @dataclasses.dataclass
+        class Database:
+            host: str
+            port: int = 5432
+            timeout: timedelta = timedelta(seconds=30)
+            replicas: typing.List[str] = dataclasses.field(default_factory=list)
+
+        class Service:
+            db: Database
+            mode: Mode
+            debug: bool
+            ratio: float
+            limits: typing.Dict[str, int]
+            retry: typing.Optional[timedelta] = None
+
+        config_class = self.make_config_class()
+        config_dir = os.path.join(config_class._user_config_home, "test_bind")
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, "config.json"), "w") as fh:
+            json.dump(dict(db=dict(host="db1", port="6432", timeout="1m30s"), mode="safe", debug="yes", ratio=1), fh)
+        config = config_class("test_bind", save_on_exit=False)
+        config.limits = dict(a="1", b=2)
+        service = config.bind(Service)
+        db = service.db
+        self.assertEqual((db.host, db.port, db.timeout, db.replicas), ("db1", 6432, timedelta(seconds=90), []))
+        self.assertEqual((service.mode, service.debug, service.ratio, service.retry), (Mode.safe, True, 1.0, None))
+        self.assertEqual(service.limits, dict(a=1, b=2))
+        self.assertEqual(type(service).__name__, "Service")
+        self.assertFalse(hasattr(service, "__dict__"))
+        self.assertEqual(config.db.bind(Database), service.db)
+        config.db.port, config.mode, config.retry, config.limits.b = "x", "slow", "5", [1]
+        del config["debug"]
+        with self.assertRaises(ConfigValidationError) as context:
+            config.bind(Service)
+        self.assertEqual(
+            [error[:2] for error in context.exception.errors],
+            [
+                (("db", "port"), "expected int, got str 'x'"),
+                (("mode",), "expected one of 'fast', 'safe', got str 'slow'"),
+                (("debug",), "missing required key"),
+                (("limits", "b"), "expected int, got list"),
+            ],
+        )
+        self.assertEqual(context.exception.errors[0][2], config.config_files[1])
+        self.assertEqual(context.exception.errors[3][2], None)
+        self.assertIn("db.port: expected int, got str 'x' (in " + config.config_files[1], str(context.exception))
+        self.assertEqual(sorted(config.reload()), [("db", "port"), ("debug",), ("limits",), ("mode",), ("retry",)])
+        with open(os.path.join(config_dir, "config.json"), "w") as fh:
+            json.dump(dict(db=dict(host="db2"), mode="fast", debug=False, ratio=0.5, limits={}), fh)
+        config.reload()
+        self.assertEqual((service.db.host, service.db.port), ("db2", 5432))
+        self.assertEqual((service.mode, service.debug, service.ratio, service.limits), (Mode.fast, False, 0.5, {}))
+
+    def test_shared_configs(self):
+        config_class, exit_configs = self.make_config_class(), weakref.WeakValueDictionary()
+        with mock.patch("tweak._shared_configs", {}), mock.patch("tweak._exit_configs", exit_configs):
+            config = config_class("test_shared")
+            config.x = 0
+            blocks = sys.getallocatedblocks()
+            for i in range(100000):
+                shared = config_class("test_shared")
+                shared.x = i
+            self.assertIs(shared, config)
+            self.assertLess(sys.getallocatedblocks() - blocks, 1000)
+            for i in range(1000):
+                config_class("test_shared", shared=False).x = i
+            gc.collect()
+            self.assertEqual(len(exit_configs), 1)
+            with mock.patch.object(
+                config_class, "_save_contents", autospec=True, side_effect=Config._save_contents
+            ) as save:
+                _save_configs_on_exit()
+            self.assertEqual(save.call_count, 1)
+            self.assertEqual(config_class("test_shared", save_on_exit=False).x, 99999)
+            with open(config.config_files[1], "w") as fh:
+                json.dump(dict(x=-1, y=1), fh)
+            self.assertIs(config_class("test_shared"), config)
+            self.assertEqual(dict(config), dict(x=-1, y=1))
+            self.assertIsNot(config_class("test_shared", autosave=True), config)
+            self.assertIsNot(copy.copy(config), config)
+            config.x, other = 1, config_class("test_shared", use_libyaml=False)
+            other.x = 2
+            with mock.patch.object(
+                config_class, "_save_contents", autospec=True, side_effect=Config._save_contents
+            ) as save:
+                _save_configs_on_exit()
+            self.assertEqual(save.call_count, 1)
+            self.assertEqual(config_class("test_shared", save_on_exit=False).x, 1)
+
+            config_dir = os.path.join(config_class._user_config_home, "test_nested_construction")
+            os.makedirs(config_dir)
+            with open(os.path.join(config_dir, "config.json"), "w") as fh:
+                json.dump(dict(x=1), fh)
+            nested = []
+            thread = threading.Thread(
+                target=lambda: nested.append(
+                    config_class(
+                        "test_nested_construction", instrument=lambda *args: nested.append(config_class("metrics"))
+                    )
+                ),
+                daemon=True,
+            )
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(nested[-1].x, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
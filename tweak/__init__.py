@@ -1,15 +1,1258 @@
 import atexit
+import copy
+import dataclasses
+import enum
 import errno
 import glob
+import inspect
 import json
 import logging
+import marshal
+import math
+import mmap
 import os
-import sys
+import re
+import select
+import tempfile
+import threading
+import time
+import types
+import typing
+import weakref
 from collections import OrderedDict
-from collections.abc import Mapping, MutableMapping
+from collections.abc import Mapping, MutableMapping, Sequence
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
 
 
-class Config(MutableMapping):
+def _to_plain(value):
+    # Copies the underlying data of config mappings and tracked lists, without wrapping the values in them. Other
+    # mappings, such as FrozenConfig, are copied to dicts, and tuples to lists.
+    if isinstance(value, _ConfigMapping):
+        value = value._data
+    if isinstance(value, Mapping):
+        return {k: v if type(v) in _scalar_types else _to_plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [v if type(v) in _scalar_types else _to_plain(v) for v in list.__iter__(value)]
+    if isinstance(value, tuple):
+        return [v if type(v) in _scalar_types else _to_plain(v) for v in value]
+    return value
+
+
+def _json_default(obj):
+    if isinstance(obj, _ConfigMapping):
+        return obj._data
+    if isinstance(obj, list):
+        return list(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def _json_portable(value):
+    # Whether the other JSON libraries write value as the standard library does. They write NaN and infinite floats as
+    # null, and reject integers that do not fit in 64 bits.
+    if type(value) is float:
+        return math.isfinite(value)
+    if type(value) is int:
+        return -(2**63) <= value < 2**64
+    if isinstance(value, _ConfigMapping):
+        value = value._data
+    if isinstance(value, Mapping):
+        return all(type(v) in _portable_types or _json_portable(v) for v in value.values())
+    if isinstance(value, list):
+        return all(type(v) in _portable_types or _json_portable(v) for v in list.__iter__(value))
+    return True
+
+
+def _get_json_codec(name):
+    """
+    Return (loads, dumps) functions for the named JSON library. dumps returns str.
+
+    Only the standard library reads and writes NaN, infinite floats and integers of any size, so the other libraries
+    fall back to it for data containing them, and for documents that they cannot parse.
+    """
+    if name == "json":
+        return json.loads, lambda data: json.dumps(data, default=_json_default)
+    elif name == "orjson":
+        import orjson
+
+        def fast_dumps(data):
+            return orjson.dumps(data, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+        fast_loads = orjson.loads
+    elif name == "ujson":
+        import ujson
+
+        def fast_dumps(data):
+            return ujson.dumps(data, default=_json_default)
+
+        fast_loads = ujson.loads
+    elif name == "msgspec":
+        import msgspec
+
+        def fast_dumps(data):
+            return msgspec.json.encode(data, enc_hook=_json_default).decode()
+
+        fast_loads = msgspec.json.decode
+    else:
+        raise ValueError("Unknown JSON backend {}".format(name))
+    json_loads, json_dumps = _get_json_codec("json")
+
+    def loads(document):
+        try:
+            return fast_loads(document)
+        except Exception:
+            return json_loads(document)
+
+    def dumps(data):
+        return fast_dumps(data) if _json_portable(data) else json_dumps(data)
+
+    return loads, dumps
+
+
+_json_codecs: dict = {}
+
+
+def _json_codec(name=None):
+    # The standard library is used unless another library is selected with json_backend.
+    if name is None:
+        name = "json"
+    if name not in _json_codecs:
+        _json_codecs[name] = _get_json_codec(name)
+    return _json_codecs[name]
+
+
+_json_whitespace = re.compile(rb"[ \t\n\r]*")
+_json_string = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_json_bracket = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*(?:([\[{])|[\]}])')
+_json_scalar = re.compile(rb"[^,\]}\s]*")
+
+
+def _json_value_end(buffer, pos):
+    # Return the offset just past the JSON value starting at pos without decoding anything. Each match of
+    # _json_bracket skips over any strings and scalars up to the next bracket, so only brackets are counted in Python.
+    # The pattern can only match a given input in one way, and is only tried at the end of the previous match, so a
+    # value that is never closed is rejected in linear time.
+    if buffer[pos : pos + 1] == b'"':
+        match = _json_string.match(buffer, pos)
+        if match is not None:
+            return match.end()
+    elif buffer[pos : pos + 1] in (b"{", b"["):
+        depth, end = 0, pos
+        while True:
+            match = _json_bracket.match(buffer, end)
+            if match is None:
+                break
+            end = match.end()
+            if match.lastindex:
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return end
+    else:
+        return _json_scalar.match(buffer, pos).end()
+    raise ValueError("Unterminated JSON value at offset {}".format(pos))
+
+
+def _scan_json_sections(buffer, keys, loads):
+    """
+    Return a dict of the values of the given keys of the JSON object in buffer (bytes or an mmap), decoded with loads.
+    The values of other keys are skipped over without being decoded.
+    """
+    contents, pos = {}, _json_whitespace.match(buffer).end()
+    if buffer[pos : pos + 1] != b"{":
+        raise ValueError("Expected a JSON object at offset {}".format(pos))
+    pos = _json_whitespace.match(buffer, pos + 1).end()
+    if buffer[pos : pos + 1] == b"}":
+        return contents
+    while True:
+        match = _json_string.match(buffer, pos)
+        if match is None:
+            raise ValueError("Expected a JSON object key at offset {}".format(pos))
+        key, pos = json.loads(match.group()), _json_whitespace.match(buffer, match.end()).end()
+        if buffer[pos : pos + 1] != b":":
+            raise ValueError("Expected ':' at offset {}".format(pos))
+        start = _json_whitespace.match(buffer, pos + 1).end()
+        end = _json_value_end(buffer, start)
+        if key in keys:
+            contents[key] = loads(buffer[start:end])
+        pos = _json_whitespace.match(buffer, end).end()
+        if buffer[pos : pos + 1] == b"}":
+            return contents
+        if buffer[pos : pos + 1] != b",":
+            raise ValueError("Expected ',' or '}}' at offset {}".format(pos))
+        pos = _json_whitespace.match(buffer, pos + 1).end()
+
+
+_yaml_codecs: dict = {}
+
+
+def _yaml_codec(use_libyaml=True):
+    """
+    Return (Loader, Dumper) classes for reading and writing YAML config files. The classes are built once, and use the
+    libyaml bindings if they are available and use_libyaml is True.
+    """
+    if use_libyaml not in _yaml_codecs:
+        import yaml
+
+        if use_libyaml and hasattr(yaml, "CSafeLoader"):
+            loader, dumper_base = yaml.CSafeLoader, yaml.CSafeDumper
+        else:
+            loader, dumper_base = yaml.SafeLoader, yaml.SafeDumper
+
+        class ConfigDumper(dumper_base):
+            pass
+
+        def config_representer(dumper, obj):
+            # Mappings are written in insertion order, whether or not they have been wrapped in config nodes yet.
+            data = obj._data if isinstance(obj, _ConfigMapping) else obj
+            return dumper.represent_mapping(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, data.items())
+
+        ConfigDumper.add_representer(_ConfigNode, config_representer)
+        ConfigDumper.add_representer(dict, config_representer)
+        ConfigDumper.add_representer(_TrackedList, yaml.SafeDumper.represent_list)
+        _yaml_codecs[use_libyaml] = loader, ConfigDumper
+    return _yaml_codecs[use_libyaml]
+
+
+def _has_merge_directives(d, directives):
+    if len(d) == 1 and next(iter(d)) in directives:
+        return True
+    return any(_has_merge_directives(v, directives) for v in d.values() if isinstance(v, Mapping))
+
+
+_scalar_types = frozenset([str, int, float, bool, type(None)])
+_portable_types = frozenset([str, bool, type(None)])
+
+
+def _unwrap(value):
+    """
+    Return value with the config mappings and tracked lists in it, which belong to a config tree, replaced by copies of
+    their contents as plain dicts and lists, any other mappings converted to dicts, and tuples converted to lists. Plain
+    dicts and lists are returned as is unless something in them needs to be replaced.
+    """
+    if type(value) is dict:
+        unwrapped = None
+        for k, v in value.items():
+            if type(v) not in _scalar_types:
+                u = _unwrap(v)
+                if u is not v:
+                    if unwrapped is None:
+                        unwrapped = dict(value)
+                    unwrapped[k] = u
+        return value if unwrapped is None else unwrapped
+    if type(value) is list:
+        unwrapped = None
+        for i, v in enumerate(value):
+            if type(v) not in _scalar_types:
+                u = _unwrap(v)
+                if u is not v:
+                    if unwrapped is None:
+                        unwrapped = list(value)
+                    unwrapped[i] = u
+        return value if unwrapped is None else unwrapped
+    if isinstance(value, (Mapping, list, tuple)):
+        return _to_plain(value)
+    return value
+
+
+def _insert(config, key, positions):
+    for position, value in positions.items():
+        config[key].insert(position, value)
+
+
+def _extendleft(config, key, values):
+    config[key][0:0] = values
+
+
+def _merge(base, ours, theirs):
+    """
+    Three-way merge of plain config dicts: apply the differences between base and ours to theirs, and return theirs.
+    """
+    for key, value in ours.items():
+        if key in base and base[key] == value:
+            continue
+        if isinstance(value, dict) and isinstance(base.get(key, {}), dict) and isinstance(theirs.get(key), dict):
+            _merge(base.get(key, {}), value, theirs[key])
+        else:
+            theirs[key] = value
+    for key in base:
+        if key not in ours:
+            theirs.pop(key, None)
+    return theirs
+
+
+class _ParseCache(object):
+    """
+    Parsed contents of config files, as marshal data keyed by path and file version. The least recently used entries
+    are evicted to keep the total size of the cached data within the max_size given to put().
+    """
+
+    def __init__(self):
+        self._entries, self._size, self._lock = OrderedDict(), 0, threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, data, max_size):
+        with self._lock:
+            self._discard(key)
+            if len(data) > max_size:
+                return
+            self._entries[key] = version, data
+            self._size += len(data)
+            while self._size > max_size:
+                self._size -= len(self._entries.popitem(last=False)[1][1])
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_load_executors: dict = {}
+
+
+def _load_executor(max_workers):
+    # Thread pools do not survive fork(), so each process creates its own.
+    key = (os.getpid(), max_workers)
+    if key not in _load_executors:
+        from concurrent.futures import ThreadPoolExecutor
+
+        _load_executors[key] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tweak-load")
+    return _load_executors[key]
+
+
+def _run_inline(func, *args):
+    from concurrent.futures import Future
+
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+_missing = object()
+
+
+def _diff(old, new, path=()):
+    """
+    Yield (path, value) for each key that differs between the plain config dicts old and new, recursing into dicts
+    present in both. value is _missing for keys that are not in new.
+    """
+    for key, value in new.items():
+        if key not in old:
+            yield path + (key,), value
+        elif old[key] != value:
+            if isinstance(old[key], dict) and isinstance(value, dict):
+                for change in _diff(old[key], value, path + (key,)):
+                    yield change
+            else:
+                yield path + (key,), value
+    for key in old:
+        if key not in new:
+            yield path + (key,), _missing
+
+
+def _digest(value, entry=None):
+    """
+    Return a digest of the contents of a config value, which is the same for equal values whatever the order of the
+    keys in their mappings. Digests are built from hash(), so they are only comparable within a process. entry is a
+    [digest, children] list in which the digests of the value, if it is a mapping, and of the mappings below it are
+    cached, or None.
+    """
+    if isinstance(value, _ConfigMapping):
+        value = value._data
+    if isinstance(value, Mapping):
+        if entry is not None and entry[0] is not None:
+            return entry[0]
+        total = 0
+        for key, item in value.items():
+            child = None
+            if entry is not None and isinstance(item, Mapping):
+                child = entry[1].get(key)
+                if child is None:
+                    child = entry[1][key] = [None, {}]
+            total += hash((key if type(key) is str else _digest(key), _digest(item, child)))
+        digest = hash((Mapping, total & 0xFFFFFFFFFFFFFFFF))
+        if entry is not None:
+            entry[0] = digest
+        return digest
+    if isinstance(value, (list, tuple)):
+        items = list.__iter__(value) if isinstance(value, list) else value
+        return hash((list, tuple(_digest(item) for item in items)))
+    if type(value) is int:
+        # hash() maps -1 and -2, and integers that differ by a multiple of 2**61 - 1, to the same value.
+        return hash((int, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)))
+    try:
+        return hash((type(value), value))
+    except TypeError:
+        return hash((type(value), repr(value)))
+
+
+def _delta(old, new, old_entry, new_entry, path, delta):
+    # Add the changes from the mapping old to the mapping new to delta, skipping over mappings whose digests are equal.
+    for key, value in new.items():
+        if key not in old:
+            delta["$set"].append([path + [key], _to_plain(value)])
+            continue
+        old_value = old[key]
+        if isinstance(old_value, Mapping) and isinstance(value, Mapping):
+            old_child = old_entry[1].setdefault(key, [None, {}])
+            new_child = new_entry[1].setdefault(key, [None, {}])
+            if _digest(old_value, old_child) != _digest(value, new_child):
+                old_data = old_value._data if isinstance(old_value, _ConfigMapping) else old_value
+                new_data = value._data if isinstance(value, _ConfigMapping) else value
+                _delta(old_data, new_data, old_child, new_child, path + [key], delta)
+        elif _digest(old_value) != _digest(value):
+            delta["$set"].append([path + [key], _to_plain(value)])
+    for key in old:
+        if key not in new:
+            delta["$delete"].append(path + [key])
+
+
+def _stat_version(stat):
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _file_version(path):
+    try:
+        return _stat_version(os.stat(path))
+    except OSError:
+        return None
+
+
+def _inotify_init(directories):
+    """
+    Return a non-blocking inotify file descriptor watching the given directories for changes to the files in them, or
+    None if inotify is not available.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (AttributeError, OSError):
+        return None
+    if fd < 0:
+        return None
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    for directory in directories:
+        libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+    return fd
+
+
+class _ConfigWatcher(threading.Thread):
+    """
+    Background thread started by Config.watch(). Waits for inotify events on the config file directories, or for the
+    poll interval to pass, and reloads the config when the stat manifest of its files changes.
+    """
+
+    def __init__(self, config, manifest, interval):
+        threading.Thread.__init__(self, name="tweak-watcher-" + config._name, daemon=True)
+        self.config, self.manifest, self.interval, self.callbacks = config, manifest, interval, []
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        config, manifest = self.config, self.manifest
+        directories = set(os.path.dirname(os.path.abspath(path)) for path, version in manifest)
+        fd = _inotify_init(d for d in directories if os.path.isdir(d))
+        try:
+            while not self._stopped.is_set():
+                if fd is None:
+                    self._stopped.wait(self.interval)
+                elif select.select([fd], [], [], self.interval)[0]:
+                    try:
+                        while os.read(fd, 65536):
+                            pass
+                    except BlockingIOError:
+                        pass
+                if self._stopped.is_set():
+                    break
+                current = config._manifest()
+                if current != manifest:
+                    try:
+                        if config.reload() is not None:
+                            manifest = current
+                    except Exception as e:
+                        config._logger.exception("Error reloading config %s: %s", config._name, e)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
+class _TrackedList(list):
+    """
+    A list held in a config tree. Notifies the root config whenever the list is mutated in place.
+    """
+
+    def __init__(self, iterable=(), root=None, path=()):
+        list.__init__(self, iterable)
+        self._root, self._path = root, path
+
+    def _lock(self):
+        return self._root._lock if self._root is not None else _no_lock
+
+    def _changed(self, operator="set", argument=None):
+        if self._root is not None:
+            self._root._changed(self._path, operator, self if operator == "set" else argument)
+
+    def append(self, value):
+        value = _unwrap(value)
+        with self._lock():
+            list.append(self, value)
+            self._changed("$append", value)
+
+    def extend(self, values):
+        values = _unwrap(list(values))
+        with self._lock():
+            list.extend(self, values)
+            self._changed("$extend", values)
+
+    def insert(self, index, value):
+        value = _unwrap(value)
+        with self._lock():
+            list.insert(self, index, value)
+            self._changed("$insert", [index, value])
+
+    def remove(self, value):
+        with self._lock():
+            list.remove(self, value)
+            self._changed("$remove", value)
+
+    def __setitem__(self, index, value):
+        value = _unwrap(list(value) if isinstance(index, slice) else value)
+        with self._lock():
+            if index == slice(0, 0):
+                list.__setitem__(self, index, value)
+                self._changed("$extendleft", value)
+            else:
+                list.__setitem__(self, index, value)
+                self._changed()
+
+    def _mutator(method):
+        def mutate(self, *args, **kwargs):
+            with self._lock():
+                result = method(self, *args, **kwargs)
+                self._changed()
+            return result
+
+        return mutate
+
+    pop = _mutator(list.pop)
+    clear = _mutator(list.clear)
+    sort = _mutator(list.sort)
+    reverse = _mutator(list.reverse)
+    __delitem__ = _mutator(list.__delitem__)
+    __iadd__ = _mutator(list.__iadd__)
+    __imul__ = _mutator(list.__imul__)
+    del _mutator
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if type(value) in (dict, list) and not isinstance(index, slice) and self._root is not None:
+            # Changes below a list element are recorded as changes to the whole list, since indices can shift.
+            with self._root._lock:
+                if list.__getitem__(self, index) is not value:
+                    return self[index]
+                value = self._root._as_config(value, self._path + (None,))
+                list.__setitem__(self, index, value)
+        return value
+
+    def __iter__(self):
+        for i, value in enumerate(list.__iter__(self)):
+            yield self[i] if type(value) in (dict, list) else value
+
+    def __reduce__(self):
+        return self.__class__, (list(self),), self.__dict__
+
+
+_no_lock = nullcontext()
+
+_journal_operators = {
+    "$append": list.append,
+    "$extend": list.extend,
+    "$insert": lambda target, argument: list.insert(target, *argument),
+    "$extendleft": lambda target, argument: list.__setitem__(target, slice(0, 0), argument),
+    "$remove": list.remove,
+}
+
+# Root configs to save or flush at interpreter exit, held weakly so that the exit handler does not keep configs that
+# are no longer in use alive.
+_exit_configs = weakref.WeakValueDictionary()
+
+# Configs handed out by Config.__new__ to every caller that constructs a config with the same class, arguments and
+# config files, the lock guarding the registry, and the locks serializing the creation of each config.
+_shared_configs: dict = {}
+_shared_configs_lock = threading.Lock()
+_shared_config_locks: dict = {}
+_init_parameters: dict = {}
+
+
+def _save_configs_on_exit():
+    # Most recently created first, the order in which atexit would call handlers registered by each config.
+    configs = list(reversed(list(_exit_configs.values())))
+    # Configs created with different arguments for the same config file are not shared. A full save of the file (one
+    # that neither merges nor appends to a journal) would overwrite whatever the configs before it wrote, so those are
+    # skipped, and each file is written once.
+    last_full_save = {}
+    for i, config in enumerate(configs):
+        if config._save_on_exit and config._dirty and config._base is None and config._journal is None:
+            last_full_save[config.config_files[-1]] = i
+    for i, config in enumerate(configs):
+        if i < last_full_save.get(config.config_files[-1], i):
+            config._logger.debug("Not saving config %s at exit, since a later save overwrites it", config._name)
+            continue
+        try:
+            config.save() if config._save_on_exit else config.flush()
+        except Exception as e:
+            config._logger.exception("Error saving config %s at exit: %s", config._name, e)
+
+
+atexit.register(_save_configs_on_exit)
+
+
+def _new_config(cls):
+    return object.__new__(cls)
+
+
+class FrozenConfig(Mapping):
+    """
+    An immutable snapshot of a config tree, returned by Config.freeze(). Supports the same item and attribute access as
+    Config. Nested mappings are FrozenConfig objects and lists are tuples.
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data=()):
+        object.__setattr__(self, "_data", {k: _freeze(v) for k, v in dict(data).items()})
+
+    def __getitem__(self, item):
+        return self._data[item]
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") or attr not in self._data:
+            raise AttributeError(attr)
+        return self._data[attr]
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("FrozenConfig is immutable")
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def __reduce__(self):
+        return self.__class__, (self._data,)
+
+
+def _freeze(value):
+    if isinstance(value, FrozenConfig):
+        return value
+    if isinstance(value, Mapping):
+        return FrozenConfig(value)
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class ConfigValidationError(ValueError):
+    """
+    Raised by Config.bind() when the config does not match the schema. ``errors`` is a list of ``(path, message,
+    source)`` tuples, where path is the tuple of keys of the invalid value and source is the config file that the value,
+    or the closest mapping containing it, was loaded from (None if it was not loaded from a config file).
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = []
+        for path, message, source in errors:
+            location = ".".join(str(key) for key in path) or "(root)"
+            lines.append("{}: {}{}".format(location, message, " (in {})".format(source) if source else ""))
+        super().__init__("\n".join(lines))
+
+
+class _SchemaError(Exception):
+    def __init__(self, path, message):
+        self.path, self.message = path, message
+
+
+_union_types = frozenset([typing.Union, getattr(types, "UnionType", typing.Union)])
+_true_strings, _false_strings = frozenset(["true", "yes", "on", "1"]), frozenset(["false", "no", "off", "0"])
+_duration = re.compile(r"\s*(\d+(?:\.\d*)?|\.\d+)\s*(ms|d|h|m|s)")
+_duration_units = {"d": 86400, "h": 3600, "m": 60, "s": 1, "ms": 0.001}
+_schema_views: dict = {}
+
+
+def _describe(value):
+    return "{} {!r}".format(type(value).__name__, value) if type(value) in _scalar_types else type(value).__name__
+
+
+def _is_schema(annotation):
+    if not isinstance(annotation, type) or issubclass(annotation, enum.Enum):
+        return False
+    return dataclasses.is_dataclass(annotation) or bool(getattr(annotation, "__annotations__", None))
+
+
+def _convert_any(value, path, errors):
+    return value
+
+
+def _convert_bool(value, path, errors):
+    if type(value) is bool:
+        return value
+    if type(value) is int and value in (0, 1):
+        return value == 1
+    if type(value) is str and value.lower() in _true_strings | _false_strings:
+        return value.lower() in _true_strings
+    raise _SchemaError(path, "expected bool, got " + _describe(value))
+
+
+def _number_converter(number_type):
+    def convert_number(value, path, errors):
+        if type(value) is number_type or number_type is float and type(value) is int:
+            return number_type(value)
+        if type(value) is str:
+            try:
+                return number_type(value)
+            except ValueError:
+                pass
+        raise _SchemaError(path, "expected {}, got {}".format(number_type.__name__, _describe(value)))
+
+    return convert_number
+
+
+def _convert_timedelta(value, path, errors):
+    # Numbers are seconds. Strings are numbers of seconds, or numbers with units, such as "1h30m" or "250ms".
+    if type(value) in (int, float):
+        return timedelta(seconds=value)
+    if type(value) is str and value.strip():
+        try:
+            return timedelta(seconds=float(value))
+        except ValueError:
+            pass
+        seconds, end = 0.0, 0
+        for match in _duration.finditer(value):
+            if match.start() != end:
+                break
+            seconds, end = seconds + float(match.group(1)) * _duration_units[match.group(2)], match.end()
+        if not value[end:].strip():
+            return timedelta(seconds=seconds)
+    raise _SchemaError(path, "expected a duration such as 90, '90s' or '1h30m', got " + _describe(value))
+
+
+def _schema_converter(annotation):
+    """
+    Return a function that converts a plain config value to the given type annotation, as ``convert(value, path,
+    errors)``. Converters raise _SchemaError for values that cannot be converted, except that errors in the fields of
+    nested schemas are added to the errors list, so that all of them can be reported at once.
+    """
+    origin, args = typing.get_origin(annotation), typing.get_args(annotation)
+    if annotation is typing.Any or annotation is object:
+        return _convert_any
+    if origin in _union_types:
+        optional, converters = type(None) in args, [_schema_converter(arg) for arg in args if arg is not type(None)]
+
+        def convert_union(value, path, errors):
+            if value is None and optional:
+                return None
+            for converter in converters:
+                attempt_errors = []
+                try:
+                    converted = converter(value, path, attempt_errors)
+                except _SchemaError as e:
+                    error = e
+                    continue
+                if not attempt_errors:
+                    return converted
+                error = _SchemaError(*attempt_errors[0])
+            raise error
+
+        return convert_union
+    if origin in (list, tuple, Sequence) or annotation in (list, tuple):
+        # Tuple[X, Y] annotates each item of a list of fixed length; Tuple[X, ...], List[X] and Sequence[X] all items.
+        fixed = origin is tuple and bool(args) and args[-1] is not Ellipsis
+        items = [_schema_converter(arg) for arg in (args if fixed else args[:1])] or [_convert_any]
+        container = tuple if tuple in (origin, annotation) else list
+
+        def convert_list(value, path, errors):
+            if type(value) is not list:
+                raise _SchemaError(path, "expected a list, got " + _describe(value))
+            if fixed and len(value) != len(items):
+                raise _SchemaError(path, "expected a list of {} items, got {}".format(len(items), len(value)))
+            if fixed:
+                return container(item(v, path + (i,), errors) for i, (item, v) in enumerate(zip(items, value)))
+            return container(items[0](v, path + (i,), errors) for i, v in enumerate(value))
+
+        return convert_list
+    if origin in (dict, Mapping) or annotation is dict:
+        key, item = [_schema_converter(arg) for arg in args] if args else (_convert_any, _convert_any)
+
+        def convert_dict(value, path, errors):
+            if type(value) is not dict:
+                raise _SchemaError(path, "expected a mapping, got " + _describe(value))
+            return {key(k, path + (k,), errors): item(v, path + (k,), errors) for k, v in value.items()}
+
+        return convert_dict
+    if not isinstance(annotation, type):
+        raise TypeError("Unsupported schema type {!r}".format(annotation))
+    if issubclass(annotation, enum.Enum):
+
+        def convert_enum(value, path, errors):
+            try:
+                return annotation(value)
+            except ValueError:
+                if type(value) is str and value in annotation.__members__:
+                    return annotation.__members__[value]
+            choices = ", ".join(repr(member.value) for member in annotation)
+            raise _SchemaError(path, "expected one of {}, got {}".format(choices, _describe(value)))
+
+        return convert_enum
+    if annotation is bool:
+        return _convert_bool
+    if annotation in (int, float):
+        return _number_converter(annotation)
+    if annotation is timedelta:
+        return _convert_timedelta
+    if _is_schema(annotation):
+        return lambda value, path, errors: _schema_view(annotation, value, path, errors)
+
+    def convert_instance(value, path, errors):
+        if not isinstance(value, annotation):
+            raise _SchemaError(path, "expected {}, got {}".format(annotation.__name__, _describe(value)))
+        return value
+
+    return convert_instance
+
+
+def _compile_schema(schema):
+    # Returns the view class generated for a schema, and (name, converter, default, default_factory, is_schema) for
+    # each of its fields. Both are built once per schema.
+    if schema not in _schema_views:
+        hints = typing.get_type_hints(schema)
+        if dataclasses.is_dataclass(schema):
+            fields = [(f.name, f.default, f.default_factory) for f in dataclasses.fields(schema)]
+        else:
+            names = [name for name in hints if typing.get_origin(hints[name]) is not typing.ClassVar]
+            fields = [(name, getattr(schema, name, _missing), _missing) for name in names]
+        fields = [
+            (
+                name,
+                _schema_converter(hints[name]),
+                _missing if default is dataclasses.MISSING else default,
+                _missing if default_factory is dataclasses.MISSING else default_factory,
+                _is_schema(hints[name]),
+            )
+            for name, default, default_factory in fields
+        ]
+        namespace = dict(__slots__=tuple(field[0] for field in fields) + ("__weakref__",), __hash__=None)
+        namespace.update(__module__=schema.__module__, __qualname__=schema.__qualname__, __doc__=schema.__doc__)
+        namespace.update(__repr__=_view_repr, __eq__=_view_eq)
+        _schema_views[schema] = type(schema.__name__, (object,), namespace), fields
+    return _schema_views[schema]
+
+
+def _schema_view(schema, value, path, errors):
+    # Fields with errors are left unset, and the errors added to errors.
+    view_class, fields = _compile_schema(schema)
+    if type(value) is not dict:
+        raise _SchemaError(path, "expected a mapping, got " + _describe(value))
+    view = object.__new__(view_class)
+    for name, converter, default, default_factory, is_schema in fields:
+        try:
+            if name in value:
+                converted = converter(value[name], path + (name,), errors)
+            elif default is not _missing:
+                converted = default
+            elif default_factory is not _missing:
+                converted = default_factory()
+            elif is_schema:
+                converted = converter({}, path + (name,), errors)
+            else:
+                raise _SchemaError(path + (name,), "missing required key")
+        except _SchemaError as e:
+            errors.append((e.path, e.message))
+            continue
+        object.__setattr__(view, name, converted)
+    return view
+
+
+def _view_repr(self):
+    fields = ("{}={!r}".format(name, getattr(self, name, None)) for name in type(self).__slots__[:-1])
+    return "{}({})".format(type(self).__name__, ", ".join(fields))
+
+
+def _view_eq(self, other):
+    if type(other) is not type(self):
+        return NotImplemented
+    return all(getattr(self, name, None) == getattr(other, name, None) for name in type(self).__slots__[:-1])
+
+
+class ConfigStats(object):
+    """
+    Timings (in seconds) and counters recorded by a Config created with instrument set. Callbacks passed as instrument
+    receive the same events as ConfigStats, as ``callback(config, event, data)``:
+
+    - ``"parse"``: a config file was read and parsed (data: path, bytes, seconds)
+    - ``"include"``: an include pattern in a config file was expanded (data: path, pattern, files)
+    - ``"merge"``: the contents of a config file were merged into the config (data: path, seconds)
+    - ``"save"``: save() or asave() was called (data: path, dirty)
+    - ``"serialize"``: the config was serialized for saving (data: path, bytes, seconds)
+    - ``"write"``: a config file or journal was written, or writing it was skipped because its contents were unchanged
+      (data: path, written, seconds)
+
+    Events for files loaded concurrently are delivered in the order that the files are merged. Events for asave() are
+    delivered on the event loop's executor threads.
+    """
+
+    def __init__(self):
+        self.parse_seconds, self.parse_bytes, self.merge_seconds, self.include_files = {}, {}, {}, {}
+        self.saves, self.clean_saves, self.writes, self.unchanged_writes = 0, 0, 0, 0
+        self.serialize_seconds, self.write_seconds = 0.0, 0.0
+
+    def __call__(self, config, event, data):
+        if event == "parse":
+            self.parse_seconds[data["path"]], self.parse_bytes[data["path"]] = data["seconds"], data["bytes"]
+        elif event == "include":
+            self.include_files[data["pattern"]] = data["files"]
+        elif event == "merge":
+            self.merge_seconds[data["path"]] = data["seconds"]
+        elif event == "save":
+            self.saves += 1
+            self.clean_saves += 0 if data["dirty"] else 1
+        elif event == "serialize":
+            self.serialize_seconds += data["seconds"]
+        elif event == "write":
+            self.writes += 1 if data["written"] else 0
+            self.unchanged_writes += 0 if data["written"] else 1
+            self.write_seconds += data["seconds"]
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(k, v) for k, v in vars(self).items()))
+
+
+class _ConfigMapping(MutableMapping):
+    """
+    Mapping and attribute access shared by Config and the nested mappings in its tree.
+    """
+
+    __slots__ = ()
+    _logger = logging.getLogger(__name__)
+
+    def update(self, *args, **kwargs):
+        """
+        Recursively merge the given mappings (or iterables of key-value pairs) and keyword arguments into this config.
+        Nested mappings are merged into existing mappings instead of replacing them, and mappings with a single key
+        that is a merge directive (see Config.merge_directives) modify the existing value. The whole update results in
+        at most one autosave.
+        """
+        if len(args) > 1:
+            raise TypeError("update expected at most 1 positional argument, got {}".format(len(args)))
+        with self._root._lock, self.batch():
+            if args:
+                self._merge(args[0] if isinstance(args[0], Mapping) else dict(args[0]))
+            if kwargs:
+                self._merge(kwargs)
+
+    def _merge(self, updates):
+        # Values that replace existing ones are stored directly, and autosave is requested once for the whole mapping.
+        # Mappings and lists are copied, so that changes to the config do not leak into the caller's data or into other
+        # keys that share a subtree with them, as YAML aliases do.
+        data, root, path, directives = self._data, self._root, self._path, self._root.merge_directives
+        assigned = False
+        for k, v in updates.items():
+            if type(v) in _scalar_types:
+                data[k] = v
+            elif type(v) is list or not isinstance(v, Mapping):
+                data[k] = v = _to_plain(v)
+            elif len(v) == 1 and next(iter(v)) in directives:
+                try:
+                    directives[next(iter(v))](self, k, next(iter(v.values())))
+                except Exception as e:
+                    self._logger.debug("Error applying %s to %s: %s", next(iter(v)), path + (k,), e)
+                continue
+            elif k not in data and type(v) is dict and not _has_merge_directives(v, directives):
+                data[k] = v = _to_plain(v)
+            else:
+                if not isinstance(data.get(k), MutableMapping):
+                    self[k] = {}
+                self[k]._merge(v)
+                continue
+            root._changed(path + (k,), "set", v)
+            assigned = True
+        if assigned and root._autosave:
+            root._request_save()
+
+    def get_path(self, path, default=None):
+        """
+        Return the value at a path of keys below this config, or default if there is no value at that path. The path
+        is either a string of keys separated by dots, or a sequence of keys. Keys of lists are their integer indices:
+
+            config.get_path("services.db.primary.host")
+            config.get_path(["hosts", "example.com", "port"], default=80)
+
+        Values found are indexed by path until the config is next modified, so that looking up the same path again
+        costs a single dictionary lookup however deep the value is. Lookups below mappings held in lists are not
+        indexed, since all the elements of a list share the same key path.
+        """
+        root = self._root
+        index = root._path_index
+        if type(path) is list:
+            path = tuple(path)
+        if self is root:
+            key = path
+        else:
+            key = (self._path, path) if None not in self._path else None
+        if key is not None:
+            try:
+                return index[key]
+            except KeyError:
+                pass
+        value = self
+        try:
+            for k in path.split(".") if isinstance(path, str) else path:
+                value = value[int(k) if isinstance(value, list) else k]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return default
+        if key is not None:
+            index[key] = value
+        return value
+
+    def set_path(self, path, value):
+        """
+        Assign value at a path of keys below this config, given as for get_path(). Mappings are created at any keys
+        along the path that do not hold one.
+        """
+        keys = path.split(".") if isinstance(path, str) else list(path)
+        with self._root._lock, self.batch():
+            parent = self
+            for k in keys[:-1]:
+                if isinstance(parent, list):
+                    k = int(k)
+                elif not isinstance(parent.get(k), (Mapping, list)):
+                    parent[k] = {}
+                parent = parent[k]
+            parent[int(keys[-1]) if isinstance(parent, list) else keys[-1]] = value
+
+    def diff(self, other):
+        """
+        Return the changes that would make this config equal to other (a config or any mapping), as a delta for
+        patch(): a dict with "$set", a list of [path, value] pairs, and "$delete", a list of paths, where each path is
+        a list of keys. The delta is plain data that can be serialized and sent to another process or host.
+
+        Mappings are compared by digests of their contents, which configs cache and only recompute below the keys that
+        changed since they were last computed. Diffing two mostly identical configs therefore skips identical subtrees
+        without visiting them, and takes time in proportion to the changed parts of the configs.
+        """
+        delta = {"$set": [], "$delete": []}
+        other_lock = other._root._lock if isinstance(other, _ConfigMapping) else _no_lock
+        with self._root._lock, other_lock:
+            entry = self._digest_entry()
+            other_entry = other._digest_entry() if isinstance(other, _ConfigMapping) else [None, {}]
+            other_data = other._data if isinstance(other, _ConfigMapping) else other
+            if _digest(self._data, entry) != _digest(other_data, other_entry):
+                _delta(self._data, other_data, entry, other_entry, [], delta)
+        return delta
+
+    def patch(self, delta):
+        """
+        Apply a delta returned by diff() to this config. The whole patch results in at most one autosave.
+        """
+        with self._root._lock, self.batch():
+            for path in delta.get("$delete", ()):
+                parent = self.get_path(path[:-1])
+                if isinstance(parent, _ConfigMapping):
+                    parent.pop(path[-1], None)
+            for path, value in delta.get("$set", ()):
+                self.set_path(path, value)
+
+    def bind(self, schema):
+        """
+        Validate this config against a schema and return a typed view of it. The schema is a dataclass, or a class with
+        type annotations, whose fields name the keys of the config:
+
+            @dataclass
+            class Database:
+                host: str
+                port: int = 5432
+                timeout: timedelta = timedelta(seconds=30)
+
+            db = config.services.bind(Database)
+
+        Values are coerced to the annotated types once, when bind() is called: strings such as "8080" or "yes" to int
+        or bool, strings and numbers to Enum members, durations such as "1h30m" or 90 to timedelta, and nested mappings
+        to views of nested schemas. Optional, Union, List, Tuple and Dict annotations are supported. If any values are
+        missing or cannot be coerced, ConfigValidationError is raised, naming the key path of each of them and the
+        config file it came from.
+
+        The view is an instance of a class generated from the schema with __slots__ for its fields, so reading its
+        attributes involves no lookups in the config, checks or conversions. Views are rebuilt in place when reload()
+        applies changes to the config files; values assigned in this process are not reflected in them until then.
+        """
+        root = self._root
+        with root._lock:
+            errors = []
+            view = _schema_view(schema, _to_plain(self._data), self._path, errors)
+            if errors:
+                raise ConfigValidationError([(path, message, root._source_file(path)) for path, message in errors])
+            if None not in self._path:
+                bindings, key = root._bindings, id(view)
+                bindings[key] = weakref.ref(view, lambda ref: bindings.pop(key, None)), schema, self._path
+        return view
+
+    def _digest_entry(self):
+        # The entry caching the digest of this mapping in its root config, or a new entry if this mapping is in a list.
+        if None in self._path:
+            return [None, {}]
+        entry = self._root._digests
+        for key in self._path:
+            entry = entry[1].setdefault(key, [None, {}])
+        return entry
+
+    def _as_config(self, d, path):
+        if isinstance(d, MutableMapping):
+            return _ConfigNode(self._root, d, path)
+        if isinstance(d, list):
+            return _TrackedList(d, root=self._root, path=path)
+        return d
+
+    def freeze(self):
+        """
+        Return an immutable snapshot of this config as a FrozenConfig. Frozen snapshots hold no references back to the
+        config, and can be read by other threads while the config is being changed.
+
+        Snapshots do not keep the pages holding them shared with forked workers: reading any Python object updates its
+        reference count, which copies the page it is on. In the fork_rss benchmark (test/benchmark.py), a worker that
+        reads a 100k-node tree dirties about 4.8 MB for a snapshot, against 6.4 MB for the Config it was taken from.
+        """
+        with self._root._lock:
+            return FrozenConfig(self._data)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that defers autosave until the outermost batch exits, so that all assignments made within it
+        result in a single save():
+
+            with config.batch():
+                for key, value in settings.items():
+                    config[key] = value
+        """
+        root = self._root
+        with root._lock:
+            root._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with root._lock:
+                root._batch_depth -= 1
+                if root._batch_depth == 0 and root._save_pending:
+                    root._request_save()
+
+    def __getitem__(self, item):
+        # Nested dicts and lists are stored as is, and wrapped the first time they are accessed.
+        value = self._data[item]
+        if type(value) in (dict, list):
+            # Publishing the wrapper is the only write made by readers. It is skipped if a writer replaced the value.
+            with self._root._lock:
+                if self._data.get(item) is not value:
+                    return self[item]
+                value = self._data[item] = self._as_config(value, self._path + (item,))
+        return value
+
+    def __setitem__(self, key, value):
+        path = self._path + (key,)
+        if type(value) not in _scalar_types:
+            value = _unwrap(value)
+        with self._root._lock:
+            self._data[key] = value
+            self._root._changed(path, "set", value)
+            if self._root._autosave:
+                self._root._request_save()
+
+    def __getattr__(self, attr):
+        if attr not in self._data:
+            raise AttributeError(attr)
+        return self[attr]
+
+    def __setattr__(self, attr, value):
+        if attr.startswith("_"):
+            object.__setattr__(self, attr, value)
+        else:
+            self.__setitem__(attr, value)
+
+    def __delitem__(self, key):
+        with self._root._lock:
+            del self._data[key]
+            self._root._changed(self._path + (key,), "del")
+
+    def __iter__(self):
+        # Thread-safe configs iterate over a copy of the keys, taken without releasing the GIL, so that writes made by
+        # other threads while iterating do not invalidate the iteration.
+        return iter(list(self._data) if self._root._thread_safe else self._data)
+
+    def items(self):
+        if not self._root._thread_safe:
+            return super().items()
+        # Views look up each key after iterating over it, which fails if another thread deleted the key since, so
+        # thread-safe configs return a list of the items copied without releasing the GIL instead.
+        return [(k, self._snapshot_value(k, v)) for k, v in list(self._data.items())]
+
+    def values(self):
+        if not self._root._thread_safe:
+            return super().values()
+        return [self._snapshot_value(k, v) for k, v in list(self._data.items())]
+
+    def _snapshot_value(self, item, value):
+        # Returns the value copied from _data as __getitem__ would, or wraps it without publishing the wrapper if the
+        # key has been deleted since it was copied.
+        if type(value) in (dict, list):
+            try:
+                return self[item]
+            except KeyError:
+                return self._as_config(value, self._path + (item,))
+        return value
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+class Config(_ConfigMapping):
     """
     Provides a self-contained (no dependencies outside the standard library), Python 2 and 3 compatible configuration
     manager. Automatically saves and restores your application's configuration in your user home directory. Uses JSON
@@ -31,7 +1274,80 @@ class Config(MutableMapping):
 
     _site_config_home = "/etc"
     _user_config_home = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
-    _logger = logging.getLogger(__name__)
+    _user_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    _parse_cache = _ParseCache()
+    _parse_cache_max_size = 32 * 1024 * 1024
+    _journal_max_size = 1024 * 1024
+    _load_workers = 8
+    merge_directives = {
+        "$append": lambda config, key, value: config[key].append(value),
+        "$extend": lambda config, key, values: config[key].extend(values),
+        "$insert": _insert,
+        "$extendleft": _extendleft,
+        "$remove": lambda config, key, value: config[key].remove(value),
+    }
+
+    def __new__(cls, *args, **kwargs):
+        key = cls._shared_key(args, kwargs)
+        if key is None:
+            return super().__new__(cls)
+        # Loading holds a lock for this key only, so that configs can be constructed while loading one, such as by
+        # instrument callbacks or subclass initializers.
+        with _shared_configs_lock:
+            config = _shared_configs.get(key)
+            if config is None:
+                lock = _shared_config_locks.setdefault(key, threading.RLock())
+        if config is None:
+            with lock:
+                config = _shared_configs.get(key)
+                if config is None:
+                    config = super().__new__(cls)
+                    config.__init__(*args, **kwargs)
+                    config._shared_manifest = config._manifest()
+                    with _shared_configs_lock:
+                        _shared_configs[key] = config
+                        _shared_config_locks.pop(key, None)
+                    return config
+        # Pick up changes made to the config files since the shared config was loaded, unless it has unsaved changes.
+        manifest = config._manifest()
+        if manifest != config._shared_manifest and not config._dirty and config.reload() is not None:
+            config._shared_manifest = manifest
+        return config
+
+    @classmethod
+    def _shared_key(cls, args, kwargs):
+        # Resolve the arguments to __init__ by name, including defaults, so that equivalent calls map to the same key.
+        parameters = _init_parameters.get(cls)
+        if parameters is None:
+            signature = inspect.signature(cls.__init__)
+            if any(p.kind in (p.VAR_POSITIONAL, p.VAR_KEYWORD) for p in signature.parameters.values()):
+                parameters = signature
+            else:
+                parameters = [(p.name, p.default) for p in signature.parameters.values()][1:]
+            _init_parameters[cls] = parameters
+        if isinstance(parameters, inspect.Signature):
+            arguments = parameters.bind(None, *args, **kwargs)
+            arguments.apply_defaults()
+            arguments = dict(arguments.arguments)
+            del arguments["self"]
+        else:
+            arguments = dict(parameters)
+            arguments.update(zip((name for name, default in parameters), args))
+            arguments.update(kwargs)
+        shared = arguments.pop("shared", None)
+        if shared is None:
+            shared = arguments.get("save_on_exit") or arguments.get("autosave")
+        if not shared:
+            return None
+        probe = object.__new__(cls)
+        probe._name, probe._use_yaml = arguments.get("name"), arguments.get("use_yaml")
+        arguments = [(k, tuple(v) if isinstance(v, list) else v) for k, v in arguments.items()]
+        key = (cls, tuple(arguments), tuple(probe.config_files))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     def __init__(
         self,
@@ -40,8 +1356,17 @@ class Config(MutableMapping):
         autosave=False,
         use_yaml=False,
         allow_includes=False,
-        _parent=None,
-        _data=None,
+        autosave_delay=None,
+        locking=False,
+        json_backend=None,
+        use_libyaml=True,
+        journal=False,
+        thread_safe=False,
+        async_save=False,
+        instrument=False,
+        shared=None,
+        sections=None,
+        parse_cache=True,
     ):
         """
         :param name:
@@ -51,24 +1376,98 @@ class Config(MutableMapping):
         :param use_yaml:
             If True, the config file will be interpreted as YAML; otherwise, as JSON. Requires the PyYAML optional
             dependency to be installed.
+        :param autosave_delay:
+            If set with autosave, assignments schedule a save() this many seconds later instead of saving immediately,
+            so that all assignments made within the window are written at once. The scheduled save() runs on a timer
+            thread, and holds a lock that assignments also take, as with thread_safe.
+        :param locking:
+            If True, save() holds an exclusive lock on a ``.lock`` file next to the config file, and merges the changes
+            made by this process into the config file's current contents instead of overwriting changes saved by other
+            processes since this config was loaded. Requires fcntl (Unix).
+        :param json_backend:
+            Name of the library used to read and write JSON config files: "json" (the standard library, used by
+            default), or "orjson", "ujson" or "msgspec", which are faster. Values that these libraries would not write
+            as the standard library does (NaN and infinite floats, and integers that do not fit in 64 bits) are written
+            with the standard library instead, and files that they cannot parse are read with the standard library.
+        :param use_libyaml:
+            If True, YAML config files are read and written with the libyaml C bindings when PyYAML was built with
+            them. Set to False to use the pure Python YAML implementation.
+        :param journal:
+            If True, save() appends the changes made since the last save to a ``.journal`` file next to the config file
+            instead of rewriting the config file, and rewrites the config file only once the journal grows past
+            ``_journal_max_size`` bytes, or if another process has saved the config file in full since the journal
+            was started. Changes recorded in a journal are applied when loading the config, whether or not journal is
+            set. Cannot be combined with locking.
+        :param thread_safe:
+            If True, the config can be shared by threads. Assignments, deletions, update(), list mutations, save() and
+            freeze() are serialized by a lock held by the config, so save() and freeze() always see a consistent tree.
+            Reads do not take the lock, except to publish the wrapper object for a nested mapping or list the first
+            time it is accessed. Iterating over a mapping in the config iterates over a snapshot of its keys, taken
+            when the iteration starts, and items() and values() return lists of the items and values at the time they
+            are called. Use ``dict(config.items())`` rather than ``dict(config)`` to copy a mapping that other threads
+            may delete keys from, since the latter looks up each key separately.
+        :param async_save:
+            If True, autosave schedules asave() on the running asyncio event loop instead of calling save() when
+            assignments are made on the event loop's thread, so that the file I/O does not block the loop.
+            autosave_delay is honored using the event loop's timers.
+        :param instrument:
+            If True, record timings and counters for loading and saving the config in ``config.stats`` (a ConfigStats
+            object). May also be a callable or a list of callables, which are called as ``callback(config, event,
+            data)`` for each event recorded (see ConfigStats), in addition to recording stats.
+        :param shared:
+            If True, constructing a config with the same class, arguments and config files as an existing shared config
+            returns the existing config instead of loading a new one, after applying any changes made to its config
+            files since they were loaded unless it has unsaved changes. By default, configs that are saved at exit
+            (save_on_exit or autosave) are shared, so that each config file is saved once at exit, and only the first
+            construction pays for loading it. Shared configs are kept until the interpreter exits; other configs are
+            only saved at exit if they are still in use.
+        :param sections:
+            List of the top-level keys of the config to load. If set, only these sections are read from each config
+            file (and the files it includes), and the rest of each JSON config file is skipped over without being
+            decoded, so loading takes time and memory in proportion to the selected sections rather than to the size
+            of the files. save() merges the changes made to the loaded sections into the config file's current
+            contents, as with locking, keeping the other sections. Cannot be combined with journal.
+        :param parse_cache:
+            If True, the parsed contents of config files are kept in a cache shared by all configs in the process, and
+            reused while the files are unchanged. The cache holds up to ``_parse_cache_max_size`` bytes of data, and
+            evicts the least recently used files beyond that. Set to False to always parse the files, for example for
+            large config files that are only loaded once.
         """
+        if "_root" in self.__dict__:
+            return
         self._name, self._autosave, self._use_yaml = name, autosave, use_yaml
         self._allow_includes = allow_includes
-        if save_on_exit and _parent is None:
-            atexit.register(self.save)
-        self._parent = _parent
-        if self._parent is None:
-            self._data = {}
-            for config_file in self.config_files:
-                try:
-                    with open(config_file) as fh:
-                        self._load(fh)
-                except Exception as e:
-                    if isinstance(e, ImportError):
-                        raise
-                    self._logger.debug(e)
-        else:
-            self._data = _data
+        self._autosave_delay, self._batch_depth, self._save_pending, self._save_timer = autosave_delay, 0, False, None
+        self._dirty, self._locking, self._base = False, locking, None
+        self._json_backend, self._use_libyaml = json_backend, use_libyaml
+        # Saves scheduled by autosave_delay run on a timer thread, so they need the lock even if thread_safe is not set.
+        self._thread_safe, self._lock = thread_safe, threading.RLock() if thread_safe or autosave_delay else _no_lock
+        self._async_save, self._asave_running, self._asave_pending = async_save, None, None
+        self._instrument = None
+        if instrument:
+            callbacks = [] if instrument is True else [instrument] if callable(instrument) else list(instrument)
+            self._instrument = [ConfigStats()] + callbacks
+        if not use_yaml:
+            _json_codec(json_backend)
+        self._save_on_exit, self._shared_manifest = save_on_exit, None
+        if save_on_exit or autosave:
+            _exit_configs[id(self)] = self
+        if journal and locking:
+            raise ValueError("journal cannot be combined with locking")
+        if journal and sections is not None:
+            raise ValueError("journal cannot be combined with sections")
+        self._sections = tuple(sections) if sections is not None else None
+        self._use_parse_cache = parse_cache
+        self._root, self._data, self._path, self._journal = self, {}, (), None
+        self._watcher, self._loaded, self._path_index, self._digests = None, None, {}, [None, {}]
+        self._bindings = {}
+        with self.batch():
+            self._load_config_files()
+            self._dirty = False
+        if journal:
+            self._journal = []
+        if self._locking or self._sections is not None:
+            self._base = _to_plain(self._data)
 
     @property
     def config_files(self):
@@ -81,147 +1480,705 @@ class Config(MutableMapping):
             config_files.extend(os.environ[config_var].split(":"))
         return config_files
 
+    @property
+    def stats(self):
+        """
+        ConfigStats recorded for this config if it was created with instrument set, or None.
+        """
+        return self._instrument[0] if self._instrument is not None else None
+
+    def _emit(self, event, **data):
+        for callback in self._instrument:
+            callback(self, event, data)
+
     @property
     def user_config_dir(self):
         return os.path.join(self._user_config_home, self._name)
 
-    def update(self, *args, **kwargs):
-        updates = OrderedDict()
-        updates.update(*args, **kwargs)
-        for k, v in updates.items():
-            if isinstance(v, Mapping):
-                try:
-                    if len(v) == 1 and list(v.keys())[0] == "$append":
-                        self[k].append(list(v.values())[0])
-                    elif len(v) == 1 and list(v.keys())[0] == "$extend":
-                        self[k].extend(list(v.values())[0])
-                    elif len(v) == 1 and list(v.keys())[0] == "$insert":
-                        for position, value in list(v.values())[0].items():
-                            self[k].insert(position, value)
-                    elif len(v) == 1 and list(v.keys())[0] == "$extendleft":
-                        self[k][0:0] = list(v.values())[0]
-                    elif len(v) == 1 and list(v.keys())[0] == "$remove":
-                        self[k].remove(list(v.values())[0])
-                    else:
-                        if k not in self:
-                            self[k] = {}
-                        self[k].update(v)
-                except Exception as e:
-                    self._logger.debug(e)
-            else:
-                self[k] = updates[k]
+    @property
+    def compiled_config_file(self):
+        filename = "config.yml.compiled" if self._use_yaml else "config.json.compiled"
+        return os.path.join(self._user_cache_home, self._name, filename)
+
+    def compile(self):
+        """
+        Read and merge the config files, and save the result with a manifest of the files that it was built from (their
+        paths, sizes, modification times and inodes) to ``compiled_config_file``, in the user cache directory. Configs
+        created after this load the compiled config directly instead of reading the config files, as long as none of
+        the files in the manifest have changed since; otherwise they read the config files as usual. Also available on
+        the command line as ``python -m tweak compile NAME``.
+
+        :returns: The path of the compiled config file.
+        """
+        loader = self._read_config_files(all_sections=True)
+        if loader._load_errors:
+            raise loader._load_errors[0]
+        contents = marshal.dumps(
+            (self._compiled_header(), loader._manifest(), loader._include_patterns, _to_plain(loader._data))
+        )
+        self._make_config_dir(self.compiled_config_file)
+        self._write_atomic(self.compiled_config_file, contents, 0o600)
+        self._logger.info("Compiled configuration to %s", self.compiled_config_file)
+        return self.compiled_config_file
+
+    def _compiled_header(self):
+        return marshal.version, self._use_yaml, self._allow_includes
+
+    def _load_compiled(self):
+        try:
+            with open(self.compiled_config_file, "rb") as fh:
+                header, manifest, include_patterns, data = marshal.loads(fh.read())
+        except Exception as e:
+            if not (isinstance(e, OSError) and e.errno == errno.ENOENT):
+                self._logger.debug("Error reading compiled config: %s", e)
+            return False
+        self._include_patterns = include_patterns
+        if header != self._compiled_header() or self._manifest() != manifest:
+            self._logger.debug("Compiled config %s is stale", self.compiled_config_file)
+            self._include_patterns = []
+            return False
+        if self._sections is not None:
+            data = {key: value for key, value in data.items() if key in self._sections}
+        self._data = data
+        self._logger.info("Loaded compiled configuration from %s", self.compiled_config_file)
+        return True
+
+    def _load_config_files(self):
+        # Config files and the files they include are read and parsed concurrently, and merged in order.
+        self._include_patterns, self._load_errors = [], []
+        if self._load_compiled():
+            return
+        for config_file, future in [(path, self._submit_read(path)) for path in self.config_files]:
+            try:
+                self._merge_config_file(config_file, future)
+            except Exception as e:
+                if isinstance(e, ImportError):
+                    raise
+                if not (isinstance(e, OSError) and e.errno == errno.ENOENT):
+                    self._load_errors.append(e)
+                self._logger.debug(e)
+        self._replay_journal(self.config_files[-1])
 
     def _parse(self, stream):
         if self._use_yaml:
             import yaml
 
-            class ConfigLoader(yaml.SafeLoader):
-                def construct_mapping(loader, node):
-                    loader.flatten_mapping(node)
-                    return self._as_config(yaml.SafeLoader.construct_mapping(loader, node))
-
-            ConfigLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, ConfigLoader.construct_mapping)
-            return yaml.load(stream, Loader=ConfigLoader) or {}
+            return yaml.load(stream, Loader=_yaml_codec(self._use_libyaml)[0]) or {}
         else:
-            return json.load(stream, object_hook=self._as_config)
+            return _json_codec(self._json_backend)[0](stream.read())
+
+    def _parse_sections(self, stream):
+        keys = set(self._sections)
+        if self._allow_includes:
+            keys.add("include")
+        if self._use_yaml:
+            return {key: value for key, value in self._parse(stream).items() if key in keys}
+        try:
+            buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            buffer = b""
+        try:
+            return _scan_json_sections(buffer, keys, _json_codec(self._json_backend)[0])
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+
+    def _parse_cached(self, stream):
+        # Parsed file contents are cached by path and invalidated when the file's mtime, size or inode change.
+        if not self._use_parse_cache:
+            return self._parse(stream) if self._sections is None else self._parse_sections(stream)
+        key, version = (os.path.abspath(stream.name), self._use_yaml), _stat_version(os.fstat(stream.fileno()))
+        if self._sections is not None:
+            key += (self._sections, self._allow_includes)
+        cached = self._parse_cache.get(key, version)
+        if cached is not None:
+            return marshal.loads(cached)
+        contents = self._parse(stream) if self._sections is None else self._parse_sections(stream)
+        try:
+            self._parse_cache.put(key, version, marshal.dumps(contents), self._parse_cache_max_size)
+        except ValueError:
+            self._parse_cache.discard(key)
+        return contents
+
+    def _submit_read(self, path):
+        if self._load_workers > 1:
+            return _load_executor(self._load_workers).submit(self._read_config_file, path)
+        return _run_inline(self._read_config_file, path)
 
-    def _load(self, stream):
-        contents = self._parse(stream)
+    def _read_config_file(self, path):
+        # Runs on a loader thread. Returns the parsed contents of the file, futures for the files that it includes, and
+        # the size of the file and the time taken to parse it if instrumentation is enabled.
+        with open(path) as fh:
+            if self._instrument is None:
+                contents, measurements = self._parse_cached(fh), None
+            else:
+                start = time.perf_counter()
+                contents = self._parse_cached(fh)
+                measurements = dict(bytes=os.fstat(fh.fileno()).st_size, seconds=time.perf_counter() - start)
+        includes = []
         if self._allow_includes and "include" in contents:
-            includes = contents["include"] if isinstance(contents["include"], (list, tuple)) else [contents["include"]]
-            for include in includes:
-                for include_file in glob.glob(os.path.join(os.path.dirname(stream.name), include)):
-                    try:
-                        with open(include_file) as fh:
-                            self._load(fh)
-                    except Exception as e:
-                        self._logger.debug(e)
+            patterns = contents["include"] if isinstance(contents["include"], (list, tuple)) else [contents["include"]]
+            for include in patterns:
+                pattern = os.path.join(os.path.dirname(path), include)
+                includes.append((pattern, [(f, self._submit_read(f)) for f in glob.glob(pattern)]))
             del contents["include"]
-        self.update(contents)
-        self._logger.info("Loaded configuration from %s", stream.name)
+        return contents, includes, measurements
 
-    def _dump(self, stream=None):
+    def _merge_config_file(self, path, future):
+        contents, includes, measurements = future.result()
+        if measurements is not None:
+            self._emit("parse", path=path, **measurements)
+        for pattern, include_files in includes:
+            self._include_patterns.append(pattern)
+            if self._instrument is not None:
+                self._emit("include", path=path, pattern=pattern, files=len(include_files))
+            for include_file, include_future in include_files:
+                try:
+                    self._merge_config_file(include_file, include_future)
+                except Exception as e:
+                    self._load_errors.append(e)
+                    self._logger.debug(e)
+        if self._instrument is None:
+            self.update(contents)
+        else:
+            start = time.perf_counter()
+            self.update(contents)
+            self._emit("merge", path=path, seconds=time.perf_counter() - start)
+        self._logger.info("Loaded configuration from %s", path)
+
+    def _dump(self, stream=None, data=None):
+        if data is None:
+            data = self._data
         if self._use_yaml:
             import yaml
 
-            class OrderedDumper(yaml.SafeDumper):
-                pass
+            return yaml.dump(data, stream=stream, default_flow_style=False, Dumper=_yaml_codec(self._use_libyaml)[1])
+        dumps = _json_codec(self._json_backend)[1]
+        if stream:
+            stream.write(dumps(data))
+            return None
+        return dumps(data)
 
-            def config_representer(dumper, obj):
-                return dumper.represent_mapping(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, obj._data.items())
+    def flush(self):
+        """
+        Run any save() that is pending because of autosave_delay, or wait for one that is in progress on the timer
+        thread to complete.
+        """
+        with self._lock:
+            if self._save_pending:
+                self.save()
 
-            OrderedDumper.add_representer(self.__class__, config_representer)
-            return yaml.dump(self._data, stream=stream, default_flow_style=False, Dumper=OrderedDumper)
-        elif stream:
-            return json.dump(self._data, stream, default=lambda obj: obj._data)
-        return json.dumps(self._data, default=lambda obj: obj._data)
+    def _changed(self, path, operator, argument=None):
+        if not self._dirty:
+            self._dirty = True
+        if self._path_index:
+            self._path_index = {}
+        if self._digests[0] is not None or self._digests[1]:
+            self._invalidate_digests(path)
+        if self._journal is not None:
+            if None in path:
+                path = path[: path.index(None)]
+                operator, argument = "set", self._lookup(path)
+            self._journal.append(_json_codec(self._json_backend)[1]([operator, path, argument]))
 
-    def _as_config(self, d):
-        if isinstance(d, MutableMapping):
-            return self.__class__(autosave=self._autosave, _parent=self, _data=d)
-        return d
+    def _invalidate_digests(self, path):
+        # Clear the cached digests of the mappings containing the changed key, and drop those cached below it.
+        entry = self._digests
+        for key in path:
+            entry[0] = None
+            parent, entry = entry, entry[1].get(key)
+            if entry is None:
+                return
+        if path:
+            del parent[1][path[-1]]
+        else:
+            self._digests = [None, {}]
+
+    def _lookup(self, path):
+        value = self
+        for key in path:
+            value = value[key]
+        return value
+
+    def _replay_journal(self, config_file):
+        try:
+            with open(config_file + ".journal") as fh:
+                records = fh.read().splitlines()
+        except OSError:
+            return
+        loads = _json_codec(self._json_backend)[0]
+        if not records or loads(records[0]) != self._journal_base(config_file):
+            self._logger.debug("Ignoring stale journal for %s", config_file)
+            return
+        for record in records[1:]:
+            try:
+                operator, path, argument = loads(record)
+                if self._sections is not None and path[0] not in self._sections:
+                    continue
+                parent = self._lookup(path[:-1])
+                if operator == "set":
+                    parent._data[path[-1]] = argument
+                elif operator == "del":
+                    del parent._data[path[-1]]
+                else:
+                    _journal_operators[operator](parent[path[-1]], argument)
+            except Exception as e:
+                self._logger.debug("Error replaying journal record %s: %s", record, e)
+
+    def _journal_base(self, config_file):
+        # Identifies the config file contents that a journal applies to. Saving the config file in full replaces it
+        # with a new inode, which invalidates any existing journal.
+        try:
+            stat = os.stat(config_file)
+            return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            return None
+
+    def _save_journal(self, config_file, mode):
+        records, self._journal = self._journal, []
+        try:
+            size = self._append_journal(config_file, records, mode)
+        except BaseException:
+            self._journal[:0] = records
+            raise
+        if size is None or size > self._journal_max_size:
+            self._compact_journal(config_file, self._data, mode)
+
+    def _append_journal(self, config_file, records, mode):
+        # Returns the size of the journal file after appending the records, or None without appending them if the
+        # journal applies to an earlier version of the config file, which was since saved in full by another process.
+        journal_file = config_file + ".journal"
+        loads, dumps = _json_codec(self._json_backend)
+        fd = os.open(journal_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, mode)
+        with os.fdopen(fd, "a+") as fh:
+            base = self._journal_base(config_file)
+            if os.fstat(fd).st_size == 0:
+                records = [dumps(base)] + records
+            else:
+                fh.seek(0)
+                try:
+                    header = loads(fh.readline())
+                except ValueError:
+                    header = _missing
+                if header != base:
+                    self._logger.debug("Journal for %s is stale", config_file)
+                    return None
+            start = time.perf_counter() if self._instrument is not None else None
+            fh.write("".join(record + "\n" for record in records))
+            fh.flush()
+            os.fsync(fh.fileno())
+            size = os.fstat(fd).st_size
+            if start is not None:
+                self._emit("write", path=journal_file, written=True, seconds=time.perf_counter() - start)
+        self._logger.debug("Saved config changes to %s", journal_file)
+        return size
+
+    def _compact_journal(self, config_file, data, mode):
+        self._save_data(config_file, data, mode)
+        os.unlink(config_file + ".journal")
+
+    def _request_save(self):
+        self._save_pending = True
+        if self._batch_depth:
+            return
+        loop = self._event_loop()
+        if loop is not None:
+            if self._save_timer is None and self._asave_pending is None:
+                if self._autosave_delay:
+                    self._save_timer = loop.call_later(self._autosave_delay, self._autosave_async)
+                else:
+                    self._autosave_async()
+        elif not self._autosave_delay:
+            self.save()
+        elif self._save_timer is None:
+            self._save_timer = threading.Timer(self._autosave_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
 
     def save(self, mode=0o600):
         """
-        Serialize the config data to the user home directory.
+        Serialize the config data to the user home directory. Does nothing if the config has not been modified since it
+        was loaded or last saved.
 
         :param mode: The octal Unix mode (permissions) for the config file.
         """
-        if self._parent is not None:
-            self._parent.save(mode=mode)
-        else:
-            contents = self._dump()
-            config_dir = os.path.dirname(os.path.abspath(self.config_files[-1]))
+        with self._lock:
+            if self._instrument is not None:
+                self._emit("save", path=self.config_files[-1], dirty=self._dirty)
+            if not self._start_save():
+                return
+            config_file = self.config_files[-1]
+            # Cleared before writing, so that changes made while the config file is being written are saved next time.
+            self._dirty = False
+            # What reload() compares the config files with is updated to the data saved, so that the next reload()
+            # does not take this save for a change made by another process.
+            data = _to_plain(self._data) if self._base is not None or self._loaded is not None else None
             try:
-                with open(self.config_files[-1]) as fh:
-                    if fh.read() == contents:
-                        self._logger.debug("Config file %s unchanged", self.config_files[-1])
-                        return
-            except Exception:
+                self._make_config_dir(config_file)
+                if self._base is not None:
+                    self._save_merged(config_file, data, mode)
+                    self._base = data
+                elif self._journal is not None:
+                    self._save_journal(config_file, mode)
+                else:
+                    self._save_data(config_file, self._data, mode)
+            except BaseException:
+                self._dirty = True
+                raise
+            if self._loaded is not None:
+                self._loaded = data
+
+    async def asave(self, mode=0o600):
+        """
+        Coroutine version of save() for asyncio applications. The config is copied on the event loop, and serialized
+        and written to the config file by the loop's default executor. Overlapping calls are collapsed, so that at most
+        one write is in flight and one more is pending at any time; each call returns once a write that includes the
+        changes made before it was called has completed.
+
+        :param mode: The octal Unix mode (permissions) for the config file.
+        """
+        import asyncio
+
+        await asyncio.shield(self._queue_asave(mode))
+
+    def _queue_asave(self, mode=0o600):
+        import asyncio
+
+        if self._asave_pending is None:
+            self._asave_pending = asyncio.ensure_future(self._run_asave(self._asave_running, mode))
+        return self._asave_pending
+
+    async def _run_asave(self, previous, mode):
+        import asyncio
+
+        if previous is not None:
+            await asyncio.wait([previous])
+        self._asave_running, self._asave_pending = self._asave_pending, None
+        loop, records = asyncio.get_running_loop(), None
+        try:
+            with self._lock:
+                if self._instrument is not None:
+                    self._emit("save", path=self.config_files[-1], dirty=self._dirty)
+                if not self._start_save():
+                    return
+                config_file = self.config_files[-1]
+                if self._journal is not None:
+                    records, self._journal = self._journal, []
+                if records is None or self._loaded is not None:
+                    data = _to_plain(self._data)
+                self._dirty = False
+            try:
+                await loop.run_in_executor(None, self._make_config_dir, config_file)
+                if self._base is not None:
+                    await loop.run_in_executor(None, self._save_merged, config_file, data, mode)
+                    self._base = data
+                elif records is not None:
+                    size = await loop.run_in_executor(None, self._append_journal, config_file, records, mode)
+                    if size is None or size > self._journal_max_size:
+                        with self._lock:
+                            data, self._journal = _to_plain(self._data), []
+                        await loop.run_in_executor(None, self._compact_journal, config_file, data, mode)
+                else:
+                    await loop.run_in_executor(None, self._save_data, config_file, data, mode)
+            except BaseException:
+                self._dirty = True
+                if records is not None and self._journal is not None:
+                    self._journal[:0] = records
+                raise
+            if self._loaded is not None:
+                self._loaded = data
+        finally:
+            self._asave_running = None
+
+    def _autosave_async(self):
+        self._queue_asave().add_done_callback(self._autosave_async_done)
+
+    def _autosave_async_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.error("Error saving config: %s", future.exception())
+
+    def _event_loop(self):
+        # Returns the running event loop if autosave should be asynchronous.
+        if self._async_save:
+            import asyncio
+
+            try:
+                return asyncio.get_running_loop()
+            except RuntimeError:
                 pass
+        return None
+
+    def _start_save(self):
+        # Cancels any scheduled autosave, and returns whether there are changes to save.
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+        self._save_pending, self._save_timer = False, None
+        return self._dirty
+
+    def _make_config_dir(self, config_file):
+        config_dir = os.path.dirname(os.path.abspath(config_file))
+        try:
+            os.makedirs(config_dir)
+        except OSError as e:
+            if not (e.errno == errno.EEXIST and os.path.isdir(config_dir)):
+                raise
+
+    def _save_merged(self, config_file, data, mode):
+        import fcntl
+
+        with open(config_file + ".lock", "a") as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
             try:
-                os.makedirs(config_dir)
-            except OSError as e:
-                if not (e.errno == errno.EEXIST and os.path.isdir(config_dir)):
-                    raise
-            with open(self.config_files[-1], "wb" if sys.version_info < (3, 0) else "w") as fh:
+                with open(config_file) as fh:
+                    on_disk = _to_plain(self._parse(fh))
+            except Exception as e:
+                self._logger.debug(e)
+                on_disk = {}
+            self._save_data(config_file, _merge(self._base, data, on_disk), mode)
+
+    def _save_data(self, config_file, data, mode):
+        if self._instrument is None:
+            self._save_contents(config_file, self._dump(data=data), mode)
+        else:
+            start = time.perf_counter()
+            contents = self._dump(data=data)
+            self._emit("serialize", path=config_file, bytes=len(contents), seconds=time.perf_counter() - start)
+            self._save_contents(config_file, contents, mode)
+
+    def _save_contents(self, config_file, contents, mode):
+        # The config file is rewritten even if it already has these contents when there is a journal next to it, since
+        # the changes in the journal would otherwise still be applied on top of it when loading the config.
+        start = time.perf_counter() if self._instrument is not None else None
+        try:
+            with open(config_file) as fh:
+                unchanged = fh.read() == contents and not os.path.exists(config_file + ".journal")
+        except Exception:
+            unchanged = False
+        if unchanged:
+            self._logger.debug("Config file %s unchanged", config_file)
+            if start is not None:
+                self._emit("write", path=config_file, written=False, seconds=time.perf_counter() - start)
+            return
+        self._write_atomic(config_file, contents, mode)
+        self._logger.debug("Saved config to %s", config_file)
+        if start is not None:
+            self._emit("write", path=config_file, written=True, seconds=time.perf_counter() - start)
+
+    def _write_atomic(self, path, contents, mode):
+        # Write to a temporary file next to the target and rename it into place, so that readers never observe a
+        # partially written config file, even if this process crashes mid-write.
+        path = os.path.realpath(path)
+        config_dir = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=config_dir, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            os.fchmod(fd, mode)
+            with os.fdopen(fd, "wb" if isinstance(contents, bytes) else "w") as fh:
                 fh.write(contents)
-            os.chmod(self.config_files[-1], mode)
-            self._logger.debug("Saved config to %s", self.config_files[-1])
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        try:
+            dir_fd = os.open(config_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError as e:
+            self._logger.debug(e)
 
-    def __getitem__(self, item):
-        if item not in self._data:
-            raise KeyError(item)
-        return self._data[item]
+    def _manifest(self):
+        # The files that the config was loaded from, and the versions of them that were read. Include patterns are
+        # expanded again, so that files added to an included directory are picked up.
+        config_files = self.config_files
+        paths = config_files + [config_files[-1] + ".journal"]
+        for pattern in self._include_patterns:
+            paths.extend(sorted(glob.glob(pattern)))
+        return [(path, _file_version(path)) for path in paths]
 
-    def __setitem__(self, key, value):
-        self._data[key] = self._as_config(value)
-        if self._autosave:
-            self.save()
+    def _read_config_files(self, all_sections=False):
+        # Load the config files into a scratch copy of this config, leaving this one untouched. Files that have not
+        # changed since they were last read are served from the parse cache.
+        loader = copy.copy(self)
+        loader._root, loader._data, loader._journal, loader._autosave, loader._locking = loader, {}, None, False, False
+        if all_sections:
+            loader._sections = None
+        loader._load_config_files()
+        return loader
 
-    def __getattr__(self, attr):
-        if attr not in self._data:
-            raise AttributeError(attr)
-        return self._data[attr]
+    def reload(self):
+        """
+        Read the config files again and apply any changes made to them to this config in place, then call the
+        callbacks registered with watch(). Changes are found by comparing the config files with their contents as last
+        read by reload() or watch(), so keys that were changed only in this process are kept unless the files changed
+        them too; the first reload() of a config that is not being watched makes it match its files. Changes applied by
+        reload() do not mark the config as modified.
 
-    def __setattr__(self, attr, value):
-        if attr.startswith("_"):
-            object.__setattr__(self, attr, value)
-        else:
-            self.__setitem__(attr, value)
+        :returns: List of the key paths (tuples of keys) that were changed, or None if a config file could not be read.
+        """
+        loader = self._read_config_files()
+        if loader._load_errors:
+            self._logger.debug("Not reloading %s: %s", self._name, loader._load_errors)
+            return None
+        loaded = _to_plain(loader._data)
+        with self._lock:
+            if self._loaded is None:
+                self._loaded = _to_plain(self._data)
+            changes = list(_diff(self._loaded, loaded))
+            for path, value in changes:
+                parent = self._data
+                for key in path[:-1]:
+                    if isinstance(parent.get(key), _ConfigMapping):
+                        parent = parent[key]._data
+                    elif isinstance(parent.get(key), MutableMapping):
+                        parent = parent[key]
+                    else:
+                        parent[key] = parent = {}
+                if value is _missing:
+                    parent.pop(path[-1], None)
+                else:
+                    parent[path[-1]] = _to_plain(value)
+            self._loaded, self._include_patterns, self._path_index = loaded, loader._include_patterns, {}
+            for path, value in changes:
+                self._invalidate_digests(path)
+            if changes and self._bindings:
+                self._rebind()
+        paths = [path for path, value in changes]
+        if paths and self._watcher is not None:
+            for callback in list(self._watcher.callbacks):
+                try:
+                    callback(self, paths)
+                except Exception as e:
+                    self._logger.exception("Error in config change callback %s: %s", callback, e)
+        return paths
 
-    def __delitem__(self, key):
-        del self._data[key]
+    def _rebind(self):
+        # Rebuild the views returned by bind() in place. Views that no longer validate keep their previous values.
+        for ref, schema, path in list(self._bindings.values()):
+            view = ref()
+            if view is None:
+                continue
+            errors = []
+            try:
+                data = _to_plain(self._lookup(path))
+            except (KeyError, TypeError):
+                data = {}
+            try:
+                new_view = _schema_view(schema, data, path, errors)
+            except _SchemaError as e:
+                errors.append((e.path, e.message))
+            if errors:
+                self._logger.warning("Not updating %s view of %s: %s", schema.__name__, self._name, errors)
+                continue
+            for name in type(view).__slots__[:-1]:
+                object.__setattr__(view, name, getattr(new_view, name))
 
-    def __iter__(self):
-        for item in self._data:
-            yield item
+    def _source_file(self, path):
+        # The config file that the value at path, or the closest mapping containing it, was last merged from. Used only
+        # to report validation errors, so the files are read again here instead of tracking sources while loading.
+        source, depth = None, -1
 
-    def __len__(self):
-        return len(self._data)
+        def visit(config_file, future):
+            nonlocal source, depth
+            try:
+                contents, includes, measurements = future.result()
+            except Exception:
+                return
+            for pattern, include_files in includes:
+                for include_file, include_future in include_files:
+                    visit(include_file, include_future)
+            value, matched = contents, 0
+            for key in path:
+                if not isinstance(value, Mapping) or key not in value:
+                    break
+                value, matched = value[key], matched + 1
+            if matched > 0 and matched >= depth:
+                source, depth = config_file, matched
 
-    def __repr__(self):
-        return repr(self._data)
+        for config_file in self.config_files:
+            visit(config_file, self._submit_read(config_file))
+        return source
+
+    def watch(self, callback=None, interval=1.0):
+        """
+        Start a background thread that calls reload() whenever the config files (including files matched by include
+        patterns) change. On Linux, changes are picked up as soon as they are made using inotify; elsewhere, the files
+        are checked every interval seconds. Readers of the config are never blocked by the watcher.
+
+        :param callback:
+            Function to call with this config and the list of changed key paths after changes are applied. watch() may
+            be called several times to register several callbacks.
+        :param interval: Number of seconds between checks of the config files' modification times.
+
+        The watcher thread applies changes while other threads may be reading the config, so watch() turns on
+        thread_safe for the config if it was not set.
+        """
+        if not self._thread_safe:
+            self._thread_safe = True
+            if self._lock is _no_lock:
+                self._lock = threading.RLock()
+        if self._watcher is None or not self._watcher.is_alive():
+            manifest, loader = self._manifest(), self._read_config_files()
+            self._loaded, self._include_patterns = _to_plain(loader._data), loader._include_patterns
+            self._watcher = _ConfigWatcher(self, manifest, interval)
+            self._watcher.start()
+        if callback is not None:
+            self._watcher.callbacks.append(callback)
+
+    def unwatch(self):
+        """
+        Stop the background thread started by watch().
+        """
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def __reduce__(self):
+        # Copies and unpickled configs are never shared, so they are created without going through __new__.
+        return _new_config, (type(self),), self.__getstate__()
+
+    def __getstate__(self):
+        transient = dict(
+            _save_timer=None,
+            _watcher=None,
+            _lock=None,
+            _asave_running=None,
+            _asave_pending=None,
+            _path_index={},
+            _digests=[None, {}],
+            _bindings={},
+        )
+        return dict(self.__dict__, **transient)
 
     def __setstate__(self, state):
         self.__dict__ = state
+        self._lock = threading.RLock() if state.get("_thread_safe") or state.get("_autosave_delay") else _no_lock
+
+
+class _ConfigNode(_ConfigMapping):
+    """
+    A nested mapping in a Config tree. Settings and save state are kept by the root Config, which is shared by all nodes
+    in the tree.
+    """
+
+    __slots__ = ("_root", "_data", "_path")
+
+    def __init__(self, root, data, path):
+        self._root, self._data, self._path = root, data, path
+
+    def save(self, mode=0o600):
+        self._root.save(mode=mode)
+
+    def flush(self):
+        self._root.flush()
+
+    def __getstate__(self):
+        return self._root, self._data, self._path
+
+    def __setstate__(self, state):
+        self._root, self._data, self._path = state
+
+
+Config.register(_ConfigNode)
@@ -0,0 +1,19 @@
+import argparse
+import logging
+
+from . import Config
+
+parser = argparse.ArgumentParser(prog="python -m tweak", description="Command line utilities for tweak configs.")
+subparsers = parser.add_subparsers(dest="command", required=True)
+compile_parser = subparsers.add_parser(
+    "compile", help="Merge the config files of an application and save the result for fast loading."
+)
+compile_parser.add_argument("name", help="Name of the application that the config belongs to.")
+compile_parser.add_argument("--yaml", action="store_true", help="Read YAML config files (use_yaml=True).")
+compile_parser.add_argument("--allow-includes", action="store_true", help="Process include directives.")
+args = parser.parse_args()
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+if args.command == "compile":
+    config = Config(args.name, save_on_exit=False, use_yaml=args.yaml, allow_includes=args.allow_includes)
+    config.compile()